@@ -0,0 +1,525 @@
+"""
+Benchmarks of the generation pipeline.
+
+    python benchmark.py render [--profile NAME] [--count N]
+    python benchmark.py pdf [--backend NAME ...] [--profile NAME] [--count N]
+    python benchmark.py profiles [--count N]
+    python benchmark.py startup [--count N]
+    python benchmark.py suite [--size small|medium|large] [--save-baseline] [--threshold 0.1]
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+import PIL.Image
+import tornado.httputil
+import tornado.web
+
+import cache
+import generator
+import loader
+import model
+import pdf
+import template
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def measure(func: Callable[[], object], count: int, warmup: int = 3) -> List[float]:
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(results: Dict[str, List[float]]):
+    width = max(len(name) for name in results)
+    for name, timings in results.items():
+        mean = statistics.mean(timings) * 1000
+        median = statistics.median(timings) * 1000
+        print(f"{name:<{width}}  mean {mean:8.3f} ms  median {median:8.3f} ms  ({len(timings)} runs)")
+
+
+# The render path template.render replaced: a RequestHandler bound to a mock application and connection
+
+
+class _MockApplication(tornado.web.Application):
+    def __init__(self, path: str):
+        self.ui_methods = {}
+        self.settings = {
+            "template_path": path,
+            "template_loader": template.get_loader(path),
+            "asset_url": None,
+        }
+        self.ui_modules = template.Renderer.UI_MODULES
+
+
+class _MockConnection:
+    content: bytes = b""
+
+    def set_close_callback(*args, **kwargs):
+        pass
+
+    def write_headers(self, start_line, headers, chunk: bytes):
+        self.content = chunk
+
+    def finish(*args, **kwargs):
+        pass
+
+
+class _MockRequest(tornado.httputil.HTTPServerRequest):
+    def __init__(self):
+        self.connection = _MockConnection()
+        self.headers = {}
+        self.method = "GET"
+        self.uri = "localhost"
+        self.remote_ip = "127.0.0.1"
+        self._finish_time = None
+        self._start_time = time.time()
+
+
+def handler_render(path: str, profile) -> str:
+    handler = tornado.web.RequestHandler(_MockApplication(path), _MockRequest())
+    handler._transforms = []
+    handler.render("index.html", profile=profile)
+    return handler.request.connection.content.decode("utf-8")
+
+
+def bench_render(args):
+    gen = generator.Generator()
+    profile = args.profile or gen.all_profiles()[0]
+    profile_data = gen.get_profile(profile)
+    path = f"templates/{profile_data.template}"
+    if handler_render(path, profile_data) != template.render(path, profile_data):
+        print("Warning: the two render paths produced different output")
+    report({
+        "RequestHandler.render": measure(lambda: handler_render(path, profile_data), args.count),
+        "template.render": measure(lambda: template.render(path, profile_data), args.count),
+    })
+
+
+def _peak_rss_mb() -> float|None:
+    """
+    Peak resident memory of this process plus that of its finished children, such as browser drivers.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def _pdf_worker(backend: str, html_path: str, count: int):
+    gen = generator.Generator(pdf_backend=backend)
+    try:
+        timings = measure(lambda: gen.pdf_printer.print_pdf(html_path), count, warmup=1)
+    finally:
+        gen.close()
+    return timings, _peak_rss_mb()
+
+
+def bench_pdf(args):
+    gen = generator.Generator()
+    profile = args.profile or gen.all_profiles()[0]
+    if not gen.generate_html(profile):
+        return
+    html_path = f"output/{profile}.html"
+    results = {}
+    # Each backend runs in a fresh process, so their memory use doesn't add up
+    context = multiprocessing.get_context("spawn")
+    for backend in args.backend or list(pdf.BACKENDS):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            try:
+                timings, peak_rss = executor.submit(_pdf_worker, backend, html_path, args.count).result()
+            except Exception as e:
+                print(f"{backend}: failed ({e})")
+                continue
+        results[backend] = timings
+        memory = f"{peak_rss:.1f} MB" if peak_rss is not None else "unknown"
+        print(f"{backend}: {len(timings) / sum(timings):.2f} PDFs/s, peak memory {memory}")
+    if results:
+        report(results)
+
+
+@dataclasses.dataclass
+class SyntheticSize:
+    """
+    The shape of synthetic profiles.
+    """
+    sections: int = 4
+    entries: int = 4
+    bullets: int = 3
+    slices: int = 5
+    # Share of words carrying Markdown, links, emails or phone numbers
+    markdown: float = 0.2
+    # Width and height of the photo in pixels, or 0 for none
+    photo_size: int = 0
+
+
+SIZES = {
+    "small": SyntheticSize(sections=2, entries=2, bullets=1, slices=3, markdown=0.1),
+    "medium": SyntheticSize(photo_size=800),
+    "large": SyntheticSize(sections=8, entries=8, bullets=6, slices=30, markdown=0.5, photo_size=3000),
+}
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+
+_MARKUP = [
+    lambda word: f"**{word}**",
+    lambda word: f"*{word}*",
+    lambda word: f"__{word}__",
+    lambda word: f"[{word}](https://example.com/{word})",
+    lambda word: f"www.{word}.example.com/",
+    lambda word: f"{word}@example.com",
+    lambda word: "+1 234 567 8901",
+]
+
+
+def synthetic_text(rng: random.Random, words: int, markdown: float) -> str:
+    result = []
+    for _ in range(words):
+        word = rng.choice(WORDS)
+        if rng.random() < markdown:
+            word = rng.choice(_MARKUP)(word)
+        result.append(word)
+    return " ".join(result)
+
+
+def _synthetic_entry(rng: random.Random, kind: int, size: SyntheticSize) -> dict:
+    text = lambda words: synthetic_text(rng, words, size.markdown)
+    bullets = [text(8) for _ in range(size.bullets)]
+    if kind == 0:
+        return {"type": "text", "text": text(40), "bullets": bullets}
+    if kind == 1:
+        start_year = rng.randint(1990, 2020)
+        return {
+            "type": "experience",
+            "title": text(3),
+            "subtitle": text(2),
+            "location": "City",
+            "start_date": {"year": start_year, "month": rng.randint(1, 12)},
+            "end_date": {"year": start_year + rng.randint(1, 5)} if rng.random() < 0.7 else "Present",
+            "description": text(20),
+            "bullets": bullets,
+        }
+    if kind == 2:
+        return {"type": "skills", "title": text(1), "skills": [rng.choice(WORDS) for _ in range(6)]}
+    if kind == 3:
+        return {"type": "slider", "title": text(1), "subtitle": "C1", "value": rng.random()}
+    if kind == 4:
+        return {"type": "quote", "text": text(15), "author": text(2)}
+    return {"type": "icon_and_text", "title": text(2), "icon": "home", "description": text(10)}
+
+
+def synthetic_profile(i: int, size: SyntheticSize|None = None, photo_file: str|None = None) -> dict:
+    """
+    Plain data for a made-up profile, as it would be read from a JSON profile.
+    The same `i` and size always give the same profile.
+    """
+    size = size or SyntheticSize()
+    rng = random.Random(i)
+    sections = []
+    for s in range(size.sections):
+        entries = [_synthetic_entry(rng, (s + e) % 6, size) for e in range(size.entries)]
+        sections.append({"title": f"Section {s}", "column": s % 2, "entries": entries})
+    if size.slices:
+        values = [{"name": rng.choice(WORDS), "weight": rng.randint(1, 20)} for _ in range(size.slices)]
+        sections.append({"title": "Chart", "column": 1, "entries": [{"type": "pie_chart", "values": values}]})
+    profile = {
+        "name": f"Person {i} Example",
+        "title": "Engineer",
+        "email": f"person{i}@example.com",
+        "phone": "+1 234 567 8901",
+        "sections": sections,
+    }
+    if photo_file:
+        profile["photo_file"] = photo_file
+    return profile
+
+
+def synthetic_photo(directory: str, size: int) -> str:
+    """
+    Saves a noisy square PNG of `size` pixels, which compresses about as badly as a photo, and returns its path.
+    """
+    path = os.path.join(directory, f"photo_{size}.png")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        image = PIL.Image.frombytes("RGB", (size, size), random.Random(size).randbytes(size * size * 3))
+        image.save(path)
+    return path
+
+
+def _read_derived(profile):
+    for _, sections in profile.sections_by_column:
+        for section in sections:
+            for entry in section.entries:
+                getattr(entry, "date_range", None)
+
+
+def bench_profiles(args):
+    data = [synthetic_profile(i) for i in range(args.count)]
+    start = time.perf_counter()
+    profiles = [loader.from_dict(d) for d in data]
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for profile in profiles:
+        _read_derived(profile)
+    unfrozen_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for profile in profiles:
+        profile.freeze()
+    freeze_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for profile in profiles:
+        _read_derived(profile)
+    frozen_time = time.perf_counter() - start
+    del profiles
+
+    # Memory is measured separately, as tracing slows loading down
+    tracemalloc.start()
+    profiles = [loader.from_dict(d) for d in data]
+    unfrozen_memory = tracemalloc.get_traced_memory()[0]
+    for profile in profiles:
+        profile.freeze()
+    frozen_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"Loaded {args.count} profiles in {load_time:.2f} s ({args.count / load_time:.0f} profiles/s), froze them in {freeze_time:.2f} s")
+    print(f"Memory: {unfrozen_memory / args.count / 1024:.1f} KiB per profile, {frozen_memory / args.count / 1024:.1f} KiB once frozen")
+    print(f"Reading derived values: {unfrozen_time * 1000:.1f} ms before freezing, {frozen_time * 1000:.1f} ms after")
+
+
+# The benchmark suite: timings of the main stages on synthetic profiles, compared against a saved baseline
+
+
+SUITE_DIR = os.path.join("output", ".benchmark")
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+
+def _result(timings: List[float], per: int = 1) -> dict:
+    """
+    Lower is better for every result, so a result is a time per unit of work.
+    """
+    return {"median": statistics.median(timings) / per, "mean": statistics.mean(timings) / per, "runs": len(timings)}
+
+
+def _workspace(directory: str, count: int, size: SyntheticSize) -> str:
+    """
+    A directory laid out like the repository, with `count` synthetic JSON profiles as its input.
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    input_dir = os.path.join(directory, "input")
+    os.makedirs(input_dir)
+    for shared in ("templates", "includes"):
+        try:
+            os.symlink(os.path.abspath(shared), os.path.join(directory, shared), target_is_directory=True)
+        except OSError:
+            shutil.copytree(shared, os.path.join(directory, shared))
+    photo_file = None
+    if size.photo_size:
+        photo_file = os.path.basename(synthetic_photo(input_dir, size.photo_size))
+    for i in range(count):
+        with open(os.path.join(input_dir, f"synthetic{i:05d}.json"), "w", encoding="utf-8") as fh:
+            json.dump(synthetic_profile(i, size, photo_file), fh)
+    return directory
+
+
+def _generator_worker(directory: str, jobs: int, with_pdf: bool) -> dict:
+    os.chdir(directory)
+    # Cold caches, as in a fresh checkout
+    cache.configure(None)
+    gen = generator.Generator()
+    results = {}
+    try:
+        with contextlib.redirect_stdout(None):
+            start = time.perf_counter()
+            gen.generate_html(jobs=jobs)
+            results["html"] = time.perf_counter() - start
+            if with_pdf:
+                start = time.perf_counter()
+                gen.generate_pdf(jobs=jobs)
+                results["pdf"] = time.perf_counter() - start
+    finally:
+        gen.close()
+    results["peak_rss_mb"] = _peak_rss_mb()
+    return results
+
+
+def run_suite(size: SyntheticSize, count: int, profiles: int, repeat: int, jobs: int, with_pdf: bool) -> Dict[str, dict]:
+    results = {}
+    profile = loader.from_dict(synthetic_profile(0, size)).freeze()
+
+    def render_cold():
+        # Fragments are cleared so every template is rendered, as for a profile seen for the first time
+        template.StylizedTemplateModule.fragments.clear()
+        template.render("templates/default", profile)
+    results["template.render (cold fragments)"] = _result(measure(render_cold, count))
+    results["template.render"] = _result(measure(lambda: template.render("templates/default", profile), count))
+
+    markdown = template.MarkdownModule(template.Renderer("templates/default"))
+    text = synthetic_text(random.Random(0), 2000, size.markdown)
+    results["MarkdownModule.render (per 1k words)"] = _result(measure(lambda: markdown.render(text), count), per=2)
+
+    if size.photo_size:
+        photo_path = synthetic_photo(SUITE_DIR, size.photo_size)
+        results["photo thumbnail (encode)"] = _result(measure(lambda: model._encode_thumbnail(photo_path, 200, "JPEG", 75, False), max(1, count // 20), warmup=1))
+        photo_profile = loader.from_dict({"name": "Photo", "photo_file": os.path.relpath(photo_path, "input")})
+        results["Profile.photo_base64 (cached)"] = _result(measure(lambda: photo_profile.photo_base64, count))
+
+    # End to end, in a fresh process so its memory use is its own
+    directory = _workspace(os.path.join(SUITE_DIR, "workspace"), profiles, size)
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        shutil.rmtree(os.path.join(directory, "output"), ignore_errors=True)
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            runs.append(executor.submit(_generator_worker, os.path.abspath(directory), jobs, with_pdf).result())
+    results["Generator HTML (per CV)"] = _result([run["html"] for run in runs], per=profiles)
+    if with_pdf:
+        results["Generator PDF (per CV)"] = _result([run["pdf"] for run in runs], per=profiles)
+    peak_rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+    if peak_rss:
+        results["Generator peak RSS (MB)"] = _result(peak_rss)
+    shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """
+    Prints the results next to the baseline and returns the names of those which regressed by more than `threshold`.
+    """
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        value = result["median"]
+        unit = "MB" if "MB" in name else "ms"
+        shown = value if unit == "MB" else value * 1000
+        line = f"{name:<{width}}  {shown:10.3f} {unit}"
+        base = baseline.get(name, {}).get("median")
+        if base:
+            change = value / base - 1
+            line += f"  {change:+7.1%} vs baseline"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+            elif change < -threshold:
+                line += "  improved"
+        print(line)
+    return regressions
+
+
+def bench_suite(args):
+    size = dataclasses.replace(SIZES[args.size], **{
+        field.name: getattr(args, field.name)
+        for field in dataclasses.fields(SyntheticSize) if getattr(args, field.name) is not None
+    })
+    print(f"Synthetic profiles: {dataclasses.asdict(size)}")
+    results = run_suite(size, args.count, args.profiles, args.repeat, args.jobs, args.with_pdf)
+    config = {"size": dataclasses.asdict(size), "profiles": args.profiles, "jobs": args.jobs, "pdf": args.with_pdf}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as fh:
+            saved = json.load(fh)
+        if saved.get("config") == config:
+            baseline = saved["results"]
+        else:
+            print(f"Not comparing against {args.baseline}: it was recorded with other options")
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump({
+                "config": config,
+                "environment": {"python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine()},
+                "results": results,
+            }, fh, indent=1)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+        sys.exit(1)
+
+
+# Startup: how long a run takes before it gets to any work, in fresh interpreters
+
+
+HEAVY_MODULES = ("template", "tornado", "selenium", "watchdog", "PIL", "fontTools", "yaml", "weasyprint", "nltk", "openai", "pypdf")
+
+
+def _run_python(args: List[str]) -> Tuple[float, str]:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return time.perf_counter() - start, result.stdout
+
+
+def bench_startup(args):
+    results = {
+        "python -c pass": [_run_python(["-c", "pass"])[0] for _ in range(args.count)],
+        "import generator": [_run_python(["-c", "import generator"])[0] for _ in range(args.count)],
+    }
+    # The first run brings the outputs up to date, so the others have nothing to do
+    _, output = _run_python(["generator.py"])
+    runs = [_run_python(["generator.py"]) for _ in range(args.count)]
+    results["generator.py"] = [seconds for seconds, _ in runs]
+    report(results)
+    if any("No changes detected" not in output for _, output in runs):
+        print("Note: generator.py found outputs to update on every run (e.g. PDFs failing to print), so it didn't measure a no-op run")
+    code = f"import sys, generator; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    loaded = _run_python(["-c", code])[1].strip()
+    print(f"Heavy modules loaded by import generator: {loaded or 'none'}")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    commands = args.add_subparsers(dest="command", required=True)
+    render_args = commands.add_parser("render", help="per-render overhead of template.render against a tornado RequestHandler")
+    render_args.add_argument("--profile", help="profile from the input directory (defaults to the first one)")
+    render_args.add_argument("--count", type=int, default=200)
+    render_args.set_defaults(func=bench_render)
+    pdf_args = commands.add_parser("pdf", help="throughput and memory use of the PDF backends")
+    pdf_args.add_argument("--backend", action="append", choices=list(pdf.BACKENDS), help="backend to measure, can be repeated (defaults to all)")
+    pdf_args.add_argument("--profile", help="profile from the input directory (defaults to the first one)")
+    pdf_args.add_argument("--count", type=int, default=10)
+    pdf_args.set_defaults(func=bench_pdf)
+    profiles_args = commands.add_parser("profiles", help="load throughput and memory use of synthetic profiles")
+    profiles_args.add_argument("--count", type=int, default=10000)
+    profiles_args.set_defaults(func=bench_profiles)
+    startup_args = commands.add_parser("startup", help="start-up time of generator.py runs with nothing to do")
+    startup_args.add_argument("--count", type=int, default=10)
+    startup_args.set_defaults(func=bench_startup)
+    suite_args = commands.add_parser("suite", help="the main stages on synthetic profiles, compared against a baseline")
+    suite_args.add_argument("--size", choices=SIZES.keys(), default="medium", help="preset shape of the synthetic profiles")
+    for field in dataclasses.fields(SyntheticSize):
+        suite_args.add_argument("--" + field.name.replace("_", "-"), type=field.type, default=None, help=f"override the preset's {field.name}")
+    suite_args.add_argument("--count", type=int, default=100, help="runs of each micro-benchmark")
+    suite_args.add_argument("--profiles", type=int, default=200, help="number of CVs generated end to end")
+    suite_args.add_argument("--repeat", type=int, default=3, help="end-to-end runs, each in a fresh process")
+    suite_args.add_argument("--jobs", "-j", type=int, default=1)
+    suite_args.add_argument("--with-pdf", action="store_true", help="also print the CVs to PDF end to end")
+    suite_args.add_argument("--baseline", default=DEFAULT_BASELINE, metavar="PATH")
+    suite_args.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    suite_args.add_argument("--threshold", type=float, default=0.1, help="slowdown against the baseline which counts as a regression")
+    suite_args.set_defaults(func=bench_suite)
+    args = args.parse_args()
+    args.func(args)
@@ -0,0 +1,124 @@
+import atexit
+import contextlib
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+import instrument
+
+# selenium is imported when the first browser starts, as it takes a while to load
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+
+def _edge(headless: bool) -> "WebDriver":
+    import selenium.webdriver
+    options = selenium.webdriver.EdgeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+    return selenium.webdriver.Edge(options=options)
+
+
+def _chrome(headless: bool) -> "WebDriver":
+    import selenium.webdriver
+    options = selenium.webdriver.ChromeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+    return selenium.webdriver.Chrome(options=options)
+
+
+def _firefox(headless: bool) -> "WebDriver":
+    import selenium.webdriver
+    options = selenium.webdriver.FirefoxOptions()
+    if headless:
+        options.add_argument("-headless")
+    return selenium.webdriver.Firefox(options=options)
+
+
+BACKENDS: Dict[str, Callable[[bool], "WebDriver"]] = {
+    "edge": _edge,
+    "chrome": _chrome,
+    "firefox": _firefox,
+}
+
+
+class BrowserPool:
+    """
+    A pool of long-lived browser drivers.
+
+    Drivers are started lazily, up to `size` at a time, and handed out with `lease()`.
+    A driver is quit and replaced after `max_renders` leases or when a lease raises.
+    """
+    backend: str
+    size: int
+    max_renders: int
+    headless: bool
+    _idle: List[Tuple["WebDriver", int]]
+
+    def __init__(self, backend: str = "edge", size: int = 1, max_renders: int = 50, headless: bool = True):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown browser backend '{backend}' (expected one of {', '.join(BACKENDS)})")
+        self.backend = backend
+        self.size = max(1, size)
+        self.max_renders = max_renders
+        self.headless = headless
+        self._idle = []
+        self._available = threading.Semaphore(self.size)
+        self._lock = threading.Lock()
+        self._closed = False
+        atexit.register(self.close)
+
+    def _acquire(self) -> Tuple["WebDriver", int]:
+        self._available.acquire()
+        with self._lock:
+            if self._closed:
+                self._available.release()
+                raise RuntimeError("Browser pool is closed")
+            if self._idle:
+                return self._idle.pop()
+        try:
+            with instrument.timer("browser.start"):
+                return BACKENDS[self.backend](self.headless), 0
+        except:
+            self._available.release()
+            raise
+
+    def _release(self, driver: "WebDriver", renders: int, broken: bool):
+        with self._lock:
+            recycle = broken or self._closed or (self.max_renders > 0 and renders >= self.max_renders)
+            if not recycle:
+                self._idle.append((driver, renders))
+        if recycle:
+            self._quit(driver)
+        self._available.release()
+
+    @staticmethod
+    def _quit(driver: "WebDriver"):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def lease(self):
+        driver, renders = self._acquire()
+        broken = True
+        try:
+            yield driver
+            broken = False
+        finally:
+            self._release(driver, renders + 1, broken)
+
+    def start(self):
+        """
+        Starts all drivers of the pool ahead of the first lease.
+        """
+        with contextlib.ExitStack() as stack:
+            for _ in range(self.size):
+                stack.enter_context(self.lease())
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for driver, _ in idle:
+            self._quit(driver)
@@ -0,0 +1,161 @@
+import collections
+import contextlib
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+CACHE_DIR: str|None = os.path.join("output", ".cache")
+
+
+def configure(cache_dir: str|None):
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+
+
+@contextlib.contextmanager
+def atomic_open(path: str):
+    """
+    Opens `path` for binary writing through a temporary file, which replaces `path` once the block completes.
+
+    Readers never see a partially written file, and `path` is left untouched if the block raises.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as fh:
+            yield fh
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def digest(*parts: bytes|str) -> str:
+    hasher = hashlib.sha1()
+    for part in parts:
+        hasher.update(part.encode("utf-8") if isinstance(part, str) else part)
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class DiskCache:
+    """
+    Blobs stored as files under CACHE_DIR/<name>, keyed by a hex digest.
+
+    Writes are atomic, so several processes can share the same cache.
+    Does nothing when disk caching is disabled (CACHE_DIR is None).
+    """
+    name: str
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def _path(self, key: str) -> str|None:
+        if CACHE_DIR is None:
+            return None
+        return os.path.join(CACHE_DIR, self.name, key)
+
+    def get(self, key: str) -> bytes|None:
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def set(self, key: str, data: bytes):
+        path = self._path(key)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path) as fh:
+            fh.write(data)
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory cache which evicts the least recently used entries.
+
+    Bounded by number of entries and optionally by the total size of the values (as measured by `sizeof`).
+    """
+    max_entries: int
+    max_size: int|None
+    hits: int
+    misses: int
+
+    def __init__(self, max_entries: int = 128, max_size: int|None = None, sizeof: Callable[[Any], int] = len):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        size = self.sizeof(value) if self.max_size is not None else 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or (self.max_size is not None and self.size > self.max_size and len(self._entries) > 1):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_digests = LRUCache(max_entries=4096)
+# Files modified this recently may be modified again without their mtime changing, on filesystems which
+# store mtimes at a coarse granularity (up to 2 s on FAT)
+RACY_MTIME_NS = 3 * 1000 * 1000 * 1000
+
+def file_digest(path: str) -> str:
+    """
+    Content hash of a file, memoized by its path, mtime and size.
+
+    Hashes of files modified within the last few seconds aren't memoized, as an edit within the same mtime
+    tick which keeps the size would go unnoticed.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    result = _digests.get(key)
+    if result is None:
+        hasher = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        result = hasher.hexdigest()
+        if time.time_ns() - stat.st_mtime_ns >= RACY_MTIME_NS:
+            _digests.set(key, result)
+    return result
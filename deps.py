@@ -0,0 +1,159 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Set
+
+import cache
+
+_recording: contextvars.ContextVar[Set[str]|None] = contextvars.ContextVar("deps_recording", default=None)
+
+
+def normalize(path: str) -> str:
+    return os.path.relpath(path)
+
+
+def track(path: str):
+    """
+    Records that the output currently being built depends on the file at `path` (which may not exist).
+    """
+    paths = _recording.get()
+    if paths is not None:
+        paths.add(normalize(path))
+
+
+@contextlib.contextmanager
+def recording():
+    """
+    Collects the files tracked inside the block. They are also tracked by any enclosing recording.
+    """
+    paths = set()
+    token = _recording.set(paths)
+    try:
+        yield paths
+    finally:
+        _recording.reset(token)
+        outer = _recording.get()
+        if outer is not None:
+            outer.update(paths)
+
+
+def _digest(path: str) -> str|None:
+    try:
+        return cache.file_digest(path)
+    except OSError:
+        return None
+
+
+class DependencyGraph:
+    """
+    The files each profile's output was built from, along with their content hashes at build time,
+    the options it was built with and the hashes of what it produced.
+
+    The graph is saved as a JSON manifest, so later runs can tell which outputs are stale
+    regardless of file mtimes.
+    """
+    VERSION = 1
+
+    _entries: Dict[str, dict]
+    _dependents: Dict[str, Set[str]]
+
+    def __init__(self):
+        self._entries = {}
+        self._dependents = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "DependencyGraph":
+        """
+        The graph saved at `path`, or an empty one if there is none or it can't be read.
+        """
+        graph = cls()
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return graph
+        if isinstance(data, dict) and data.get("version") == cls.VERSION:
+            for profile, entry in data.get("profiles", {}).items():
+                graph.restore(profile, entry)
+        return graph
+
+    def save(self, path: str):
+        with self._lock:
+            data = {"version": self.VERSION, "profiles": dict(sorted(self._entries.items()))}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with cache.atomic_open(path) as fh:
+            fh.write(json.dumps(data, indent=1).encode("utf-8"))
+
+    def knows(self, profile: str) -> bool:
+        return profile in self._entries
+
+    def files(self, profile: str) -> List[str]:
+        return sorted(self._entries.get(profile, {}).get("files", ()))
+
+    def entry(self, profile: str) -> dict|None:
+        """
+        Everything recorded about the profile, in a form that can be passed to `restore`.
+        """
+        return self._entries.get(profile)
+
+    def restore(self, profile: str, entry: dict):
+        with self._lock:
+            self._forget(profile)
+            self._entries[profile] = entry
+            for path in entry["files"]:
+                self._dependents.setdefault(path, set()).add(profile)
+
+    def record(self, profile: str, paths: Iterable[str], options: str = ""):
+        """
+        Records a new build of the profile, replacing the files and options of any previous one.
+        Its outputs are kept, for comparison with the new ones.
+        """
+        files = {path: _digest(path) for path in sorted(normalize(path) for path in paths)}
+        outputs = dict(self._entries.get(profile, {}).get("outputs", {}))
+        self.restore(profile, {"options": options, "files": files, "outputs": outputs})
+
+    def set_output(self, profile: str, kind: str, digest: str):
+        with self._lock:
+            entry = self._entries.get(profile)
+            if entry is not None:
+                entry["outputs"][kind] = digest
+
+    def output(self, profile: str, kind: str) -> str|None:
+        return self._entries.get(profile, {}).get("outputs", {}).get(kind)
+
+    def _forget(self, profile: str):
+        entry = self._entries.pop(profile, None)
+        for path in entry["files"] if entry is not None else ():
+            dependents = self._dependents.get(path)
+            if dependents is not None:
+                dependents.discard(profile)
+                if not dependents:
+                    del self._dependents[path]
+
+    def forget(self, profile: str):
+        with self._lock:
+            self._forget(profile)
+
+    def dependents(self, path: str) -> Set[str]:
+        """
+        The profiles which were built from `path`. Whether they're stale is up to `is_stale`.
+        """
+        with self._lock:
+            return set(self._dependents.get(normalize(path), ()))
+
+    def is_stale(self, profile: str, options: str = "") -> bool|None:
+        """
+        Whether any of the files the profile was built from changed since, or it was built with other options.
+        None if the profile wasn't built yet.
+        """
+        with self._lock:
+            entry = self._entries.get(profile)
+            if entry is None:
+                return None
+            if entry["options"] != options:
+                return True
+            files = list(entry["files"].items())
+        return any(_digest(path) != digest for path, digest in files)
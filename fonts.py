@@ -0,0 +1,92 @@
+import functools
+import html
+import importlib.util
+import io
+import logging
+import re
+from typing import Iterable, Set, Tuple
+
+import cache
+import deps
+import instrument
+
+# fontTools is only imported once a font is subset, as it takes a while to load.
+# fontTools warns about harmless quirks of the fonts it reads
+logging.getLogger("fontTools").setLevel(logging.ERROR)
+
+STYLE_RE = re.compile(rb"<(style|script)\b.*?</\1>", re.DOTALL | re.IGNORECASE)
+CSS_CONTENT_RE = re.compile(rb"content:\s*(['\"])(.*?)\1")
+TAG_RE = re.compile(rb"<[^>]*>")
+ICON_CLASS_RE = re.compile(rb"\bicon-([\w-]+)")
+ICON_RULE_RE = re.compile(rb"\.icon-([\w-]+):before\s*\{\s*content:\s*['\"]\\([0-9a-fA-F]+)['\"]")
+
+_subsets = cache.LRUCache(max_entries=64, max_size=16 * 1024 * 1024)
+_subsets_disk = cache.DiskCache("fonts")
+
+
+@functools.lru_cache(maxsize=None)
+def available() -> bool:
+    return importlib.util.find_spec("fontTools") is not None
+
+
+@functools.lru_cache(maxsize=None)
+def flavor() -> str:
+    """
+    The format subset fonts are saved in: WOFF2 when brotli is installed, otherwise WOFF.
+    """
+    return "woff2" if importlib.util.find_spec("brotli") is not None else "woff"
+
+
+def text_codepoints(document: bytes) -> Set[int]:
+    """
+    Characters a document may display with its text fonts.
+    Both cases are included, as CSS can transform the case of the text.
+    """
+    css_content = b"".join(m.group(2) for m in CSS_CONTENT_RE.finditer(document))
+    text = TAG_RE.sub(b" ", STYLE_RE.sub(b" ", document))
+    text = html.unescape((text + b" " + css_content).decode("utf-8"))
+    return {ord(c) for c in text + text.upper() + text.lower() if c.isprintable()}
+
+
+def icon_codepoints(document: bytes) -> Set[int]:
+    """
+    Code points of the icons a document uses, as mapped by its .icon-<name>:before rules.
+    """
+    rules = {m.group(1): int(m.group(2), 16) for m in ICON_RULE_RE.finditer(document)}
+    used = set(ICON_CLASS_RE.findall(STYLE_RE.sub(b" ", document)))
+    return {rules[name] for name in used if name in rules}
+
+
+def subset(path: str, codepoints: Iterable[int]) -> Tuple[bytes, str]:
+    """
+    The font at `path` reduced to the glyphs of `codepoints`, along with its format.
+
+    Subsets are cached in memory and on disk by the font's content hash and the set of code points,
+    so profiles using the same characters share them.
+    """
+    if not available():
+        raise RuntimeError("Font subsetting requires fonttools (pip install fonttools brotli)")
+    deps.track(path)
+    codepoints = sorted(set(codepoints))
+    font_flavor = flavor()
+    key = cache.digest(cache.file_digest(path), font_flavor, ",".join(f"{c:x}" for c in codepoints))
+    data = _subsets.get(key)
+    if data is None:
+        data = _subsets_disk.get(key)
+        if data is None:
+            instrument.count("font.subsets_built")
+            import fontTools.subset
+            options = fontTools.subset.Options()
+            options.flavor = font_flavor
+            options.notdef_outline = True
+            with instrument.timer("font.subset"):
+                font = fontTools.subset.load_font(path, options)
+                subsetter = fontTools.subset.Subsetter(options)
+                subsetter.populate(unicodes=codepoints)
+                subsetter.subset(font)
+                buffer = io.BytesIO()
+                fontTools.subset.save_font(font, buffer, options)
+                data = buffer.getvalue()
+            _subsets_disk.set(key, data)
+        _subsets.set(key, data)
+    return data, font_flavor
@@ -1,45 +1,138 @@
+"""
+Generates the HTML and PDF of each profile in input.
+
+Modules which take a while to import (template and tornado, selenium, watchdog, PIL, fontTools, the test
+dependencies) are imported where they're first needed, so runs which find nothing to do start quickly.
+"""
 import argparse
-import base64
-import importlib
+import concurrent.futures
 import os
-import selenium
-import selenium.webdriver
-from selenium.webdriver.common.print_page_options import PrintOptions
 import sys
-import time
+import threading
 import traceback
-from typing import Dict, Tuple
-import watchdog.observers
-import watchdog.events
+from typing import List, Set, Tuple
 
+import browser
+import cache
+import deps
+import fonts
+import instrument
+import loader
 import model
-import template
+import pdf
 
 
 class Generator:
-    _profiles: Dict[str, Tuple[model.Profile, float]]
+    _profiles: cache.LRUCache
+    _browsers: browser.BrowserPool|None
+    _pdf: pdf.PdfBackend|None
+    dependencies: deps.DependencyGraph
+    failed_html: Set[str]
+
+    ASSET_MODES = ("inline", "bundle")
+    MANIFEST_PATH = "output/.manifest.json"
+
+    def __init__(self, browser_backend: str = "edge", browser_pool_size: int = 1, browser_max_renders: int = 50, assets: str = "inline", subset_fonts: bool = False, pdf_backend: str = "selenium", profile_cache_size: int = 256):
+        if assets not in self.ASSET_MODES:
+            raise ValueError(f"Unknown asset mode '{assets}' (expected one of {', '.join(self.ASSET_MODES)})")
+        self.assets = assets
+        self.subset_fonts = subset_fonts
+        self._profiles = cache.LRUCache(max_entries=profile_cache_size)
+        self._profiles_lock = threading.Lock()
+        self.profile_hits = 0
+        self.profile_misses = 0
+        # Profiles whose HTML failed to build in this run. Whatever HTML they have left is out of date.
+        self.failed_html = set()
+        self._browsers = None
+        self._pdf = None
+        self.pdf_backend = pdf_backend
+        self.dependencies = deps.DependencyGraph.load(self.MANIFEST_PATH)
+        self.browser_backend = browser_backend
+        self.browser_pool_size = browser_pool_size
+        self.browser_max_renders = browser_max_renders
 
-    def __init__(self):
-        self._profiles = {}
+    @property
+    def browsers(self) -> browser.BrowserPool:
+        if self._browsers is None:
+            self._browsers = browser.BrowserPool(
+                self.browser_backend,
+                size=self.browser_pool_size,
+                max_renders=self.browser_max_renders,
+            )
+        return self._browsers
+
+    @property
+    def pdf_printer(self) -> pdf.PdfBackend:
+        if self._pdf is None:
+            self._pdf = pdf.create(self.pdf_backend, self)
+        return self._pdf
+
+    def close(self):
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+        if self._browsers is not None:
+            self._browsers.close()
+            self._browsers = None
 
     def all_profiles(self):
-        return [f[:-3] for f in os.listdir("input") if f.endswith(".py") and "template" not in f]
+        return loader.names("input")
+
+    def profile_path(self, profile: str) -> str:
+        return loader.path(profile, "input")
     
     def _read_profile(self, profile: str) -> model.Profile:
-        src_module = importlib.import_module("input." + profile)
-        src_module = importlib.reload(src_module)
-        return src_module.PROFILE
+        return loader.load(self.profile_path(profile))
+
+    @staticmethod
+    def _signature(paths: List[str]) -> Tuple[Tuple[str, str|None], ...]:
+        signature = []
+        for path in paths:
+            try:
+                signature.append((path, cache.file_digest(path)))
+            except OSError:
+                signature.append((path, None))
+        return tuple(signature)
 
     def get_profile(self, profile: str) -> model.Profile:
-        data, read_time = self._profiles.get(profile, (None, 0))
-        if data is None or read_time < os.path.getmtime(f"input/{profile}.py"):
+        """
+        The parsed profile, cached until the content of its source or of the files it references changes.
+        """
+        path = self.profile_path(profile)
+        cached = self._profiles.get(profile)
+        if cached is not None:
+            signature, data = cached
+            if signature[0][0] == path and self._signature([p for p, _ in signature]) == signature:
+                with self._profiles_lock:
+                    self.profile_hits += 1
+                instrument.count("profile.cache_hits")
+                return data
+        with self._profiles_lock:
+            self.profile_misses += 1
+        instrument.count("profile.cache_misses")
+        # The source is hashed before it's read, so a concurrent edit can't be cached under the new hash
+        source_signature = self._signature([path])
+        with instrument.timer("profile.load"):
             data = self._read_profile(profile)
-            self._profiles[profile] = (data, time.time())
+        self._profiles.set(profile, (source_signature + self._signature(data.asset_paths), data))
         return data
 
+    @property
+    def build_options(self) -> str:
+        """
+        The options which change the generated HTML. Outputs built with different ones are stale.
+        """
+        return f"assets={self.assets},subset_fonts={self.subset_fonts}"
+
     def needs_update(self, profile: str|None = None):
         if profile is None:
             return any(self.needs_update(p) for p in self.all_profiles())
+        output_path = f"output/{profile}.html"
+        if not os.path.exists(output_path):
+            return True
+        stale = self.dependencies.is_stale(profile, self.build_options)
+        if stale is not None:
+            return stale or self.dependencies.output(profile, "html") != cache.file_digest(output_path)
         profile_data = self.get_profile(profile)
         template_max_mtime = 0.0
         for root, _, files in os.walk(f"templates/{profile_data.template}"):
@@ -48,22 +141,77 @@ class Generator:
                     mtime = os.path.getmtime(os.path.join(root, file))
                     if mtime > template_max_mtime:
                         template_max_mtime = mtime
-        profile_mtime = os.path.getmtime(f"input/{profile}.py")
-        output_path = f"output/{profile}.html"
-        output_mtime = os.path.getmtime(output_path) if os.path.exists(output_path) else 0.0
+        profile_mtime = os.path.getmtime(self.profile_path(profile))
+        output_mtime = os.path.getmtime(output_path)
         return profile_mtime > output_mtime or template_max_mtime > output_mtime
 
-    def generate_html(self, profile: str|None = None):
+    def _pdf_key(self, profile: str) -> str|None:
+        try:
+            return cache.digest(cache.file_digest(f"output/{profile}.html"), self.pdf_backend)
+        except OSError:
+            return None
+
+    def _printable(self, profile: str) -> bool:
+        """
+        Whether the profile has HTML to print, which didn't fail to build in this run.
+        """
+        return profile not in self.failed_html and os.path.exists(f"output/{profile}.html")
+
+    def pdf_needs_update(self, profile: str|None = None) -> bool:
+        """
+        Whether the profile's PDF is missing or wasn't printed from its current HTML.
+        """
         if profile is None:
-            for profile in self.all_profiles():
-                self.generate_html(profile)
-            return
-        print(f"[{profile}] Generating HTML...")
-        profile_data = self.get_profile(profile)
-        template_path = f"templates/{profile_data.template}"
+            return any(self.pdf_needs_update(p) for p in self.all_profiles())
+        if not os.path.exists(f"output/{profile}.pdf") or not os.path.exists(f"output/{profile}.html"):
+            return True
+        return self.dependencies.output(profile, "pdf") != self._pdf_key(profile)
+
+    def affected_profiles(self, paths: List[str]) -> List[str]:
+        """
+        Profiles whose output is stale after the given files changed.
+        Dependents of the files are only affected if a file's content actually changed, so touching
+        a file or checking out the same version of it rebuilds nothing.
+        """
+        candidates = set()
+        for path in paths:
+            candidates.update(self.dependencies.dependents(path))
+        return [
+            profile for profile in self.all_profiles()
+            if (profile in candidates or not self.dependencies.knows(profile)) and self._may_need_update(profile)
+        ]
+
+    def stale_profiles(self) -> List[str]:
+        """
+        Profiles whose HTML is missing or out of date.
+        """
+        return [p for p in self.all_profiles() if self._may_need_update(p)]
+
+    def _may_need_update(self, profile: str) -> bool:
+        try:
+            return self.needs_update(profile)
+        except Exception:
+            # A profile which fails to load is rebuilt, so the build reports the error
+            return True
+
+    def _build_html(self, profile: str) -> str|None:
+        with instrument.timer("html.build"):
+            return self._write_html(profile)
+
+    def _write_html(self, profile: str) -> str|None:
+        import template
+        os.makedirs("output", exist_ok=True)
+        output_path = f"output/{profile}.html"
         try:
-            html = template.generate(template_path, profile_data)
+            with deps.recording() as dependencies:
+                deps.track(self.profile_path(profile))
+                profile_data = self.get_profile(profile)
+                template_path = f"templates/{profile_data.template}"
+                asset_url = template.bundle_asset if self.assets == "bundle" else None
+                with cache.atomic_open(output_path) as fh:
+                    template.render_to(fh, template_path, profile_data, asset_url, self.subset_fonts)
         except Exception as e:
+            self.dependencies.forget(profile)
             exc_type, exc_value, exc_traceback = sys.exc_info()
             tb = traceback.extract_tb(exc_traceback)[-1]
             filename, line_number, function_name, text = tb
@@ -72,84 +220,244 @@ class Generator:
                 if comment_idx >= 0:
                     template_location = text[comment_idx + 4:]
                     text = text[:comment_idx]
-                    print(f"[{profile}] Failed to generate HTML @ {template_location}")
-                    print(f"    {text.strip()}")
-                    print(f"    {e}")
-                    return
-            print(f"[{profile}] Failed to generate HTML:", e)
-            return
-        os.makedirs("output", exist_ok=True)
-        output_path = f"output/{profile}.html"
-        with open(output_path, "wt", encoding="utf-8") as fh:
-            fh.write(html)
+                    return "\n".join([
+                        f"[{profile}] Failed to generate HTML @ {template_location}",
+                        f"    {text.strip()}",
+                        f"    {e}",
+                    ])
+            return f"[{profile}] Failed to generate HTML: {e}"
+        self.dependencies.record(profile, dependencies, self.build_options)
+        self.dependencies.set_output(profile, "html", cache.file_digest(output_path))
 
-    def generate_pdf(self, profile: str|None = None):
-        if profile is None:
-            for profile in self.all_profiles():
-                self.generate_pdf(profile)
-            return
-        print(f"[{profile}] Converting to PDF...")
-        with selenium.webdriver.Edge() as driver:
-            html_path = f"output/{profile}.html"
-            driver.get("file://" + os.path.abspath(html_path))
-            options = PrintOptions()
-            options.orientation = "portrait"
-            # A4 in cm
-            options.page_width = 21.0
-            options.page_height = 29.7
-            # cm
-            options.margin_bottom = 0.0
-            options.margin_top = 0.0
-            options.margin_left = 0.0
-            options.margin_right = 0.0
-            options.scale = 1.0
-            pdf = driver.print_page(options)
-        pdf_bytes = base64.b64decode(pdf)
+    def _build_pdf(self, profile: str) -> str|None:
+        html_path = f"output/{profile}.html"
+        inline_path = None
+        if not self._printable(profile):
+            return f"[{profile}] Failed to convert to PDF: its HTML wasn't generated"
+        try:
+            if self.assets != "inline":
+                import template
+                # PDFs always get their assets inlined
+                html_path = inline_path = f"output/.{profile}.inline.html"
+                profile_data = self.get_profile(profile)
+                with instrument.timer("pdf.inline_html"), cache.atomic_open(inline_path) as fh:
+                    template.render_to(fh, f"templates/{profile_data.template}", profile_data, subset_fonts=self.subset_fonts)
+            with instrument.timer("pdf.print"):
+                pdf_bytes = self.pdf_printer.print_pdf(html_path)
+        except Exception as e:
+            return f"[{profile}] Failed to convert to PDF: {e}"
+        finally:
+            if inline_path is not None and os.path.exists(inline_path):
+                os.remove(inline_path)
         os.makedirs("output", exist_ok=True)
         pdf_path = f"output/{profile}.pdf"
         with open(pdf_path, "wb") as fh:
             fh.write(pdf_bytes)
 
+    def _process_pool(self, jobs: int) -> "concurrent.futures.ProcessPoolExecutor":
+        options = {
+            "assets": self.assets,
+            "subset_fonts": self.subset_fonts,
+            "pdf_backend": self.pdf_backend,
+        }
+        initargs = (cache.CACHE_DIR, options, instrument.ENABLED, instrument.profiling_path())
+        return concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_job, initargs=initargs)
 
-class GenerateHandler(watchdog.events.FileSystemEventHandler):
-    gen: Generator
+    def _summarize(self, stage: str, results: List[Tuple[str, str|None]]) -> bool:
+        errors = [error for _, error in results if error]
+        print(f"{stage}: {len(results) - len(errors)} generated, {len(errors)} failed")
+        for error in errors:
+            print(error)
+        return not errors
 
-    def __init__(self, gen: Generator):
-        self.gen = gen
+    def generate_html(self, profile: str|None = None, jobs: int = 1, profiles: List[str]|None = None) -> bool:
+        """
+        Generates the HTML of the profile, or else of `profiles`, by default all of them.
+        """
+        if profile is None:
+            if profiles is None:
+                profiles = self.all_profiles()
+            if jobs <= 1 or len(profiles) <= 1:
+                # The manifest is saved once for the batch, as it's rewritten as a whole
+                results = [self._generate_html(p) for p in profiles]
+                self.dependencies.save(self.MANIFEST_PATH)
+                return all(results)
+            print(f"Generating HTML for {len(profiles)} profiles ({jobs} jobs)...")
+            with self._process_pool(jobs) as executor:
+                results = []
+                for profile, (error, entry, stats) in zip(profiles, executor.map(_html_job, profiles)):
+                    instrument.merge(stats)
+                    self._html_result(profile, error)
+                    if error is None:
+                        self.dependencies.restore(profile, entry)
+                    results.append((profile, error))
+            self.dependencies.save(self.MANIFEST_PATH)
+            return self._summarize("HTML", results)
+        success = self._generate_html(profile)
+        self.dependencies.save(self.MANIFEST_PATH)
+        return success
+
+    def _generate_html(self, profile: str) -> bool:
+        print(f"[{profile}] Generating HTML...")
+        error = self._build_html(profile)
+        if error:
+            print(error)
+        self._html_result(profile, error)
+        return error is None
 
-    def on_modified(self, event):
-        if self.gen.needs_update():
-            self.gen.generate_html()
+    def _html_result(self, profile: str, error: str|None):
+        if error is None:
+            self.failed_html.discard(profile)
+        else:
+            # A failed build forgets the profile's previous one, including when it ran in a worker process
+            self.failed_html.add(profile)
+            self.dependencies.forget(profile)
+
+    def generate_pdf(self, profile: str|None = None, jobs: int = 1, force: bool = False) -> bool:
+        """
+        Prints the PDF of the profile, or of all profiles. Unless `force` is set, PDFs which
+        were already printed from the current HTML are skipped.
+        """
+        if profile is None:
+            profiles = self.all_profiles()
+            unprintable = [p for p in profiles if not self._printable(p)]
+            for p in unprintable:
+                print(f"[{p}] Skipping PDF, as its HTML wasn't generated")
+            profiles = [p for p in profiles if p not in unprintable and (force or self.pdf_needs_update(p))]
+            if jobs <= 1 or len(profiles) <= 1:
+                results = [self._generate_pdf(p) for p in profiles]
+                self.dependencies.save(self.MANIFEST_PATH)
+                return all(results)
+            print(f"Converting {len(profiles)} profiles to PDF ({jobs} jobs)...")
+            try:
+                executor_kind = self.pdf_printer.executor
+            except Exception as e:
+                print(f"Failed to start the {self.pdf_backend} PDF backend: {e}")
+                return False
+            if executor_kind == "processes":
+                with self._process_pool(jobs) as executor:
+                    results = []
+                    for profile, (error, stats) in zip(profiles, executor.map(_pdf_job, profiles)):
+                        instrument.merge(stats)
+                        results.append((profile, error))
+            else:
+                with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                    results = list(zip(profiles, executor.map(self._build_pdf, profiles)))
+            for profile, error in results:
+                if error is None:
+                    self._record_pdf(profile)
+            self.dependencies.save(self.MANIFEST_PATH)
+            return self._summarize("PDF", results)
+        if not force and not self.pdf_needs_update(profile):
+            print(f"[{profile}] PDF is up to date")
+            return True
+        success = self._generate_pdf(profile)
+        if success:
+            self.dependencies.save(self.MANIFEST_PATH)
+        return success
+
+    def _generate_pdf(self, profile: str) -> bool:
+        print(f"[{profile}] Converting to PDF...")
+        error = self._build_pdf(profile)
+        if error:
+            print(error)
+        else:
+            self._record_pdf(profile)
+        return error is None
+
+    def _record_pdf(self, profile: str):
+        key = self._pdf_key(profile)
+        if key is not None:
+            self.dependencies.set_output(profile, "pdf", key)
+
+
+_job_generator: Generator|None = None
+
+def _init_job(cache_dir: str|None, options: dict, instrumented: bool, profile_path: str|None):
+    global _job_generator
+    cache.configure(cache_dir)
+    instrument.enable(instrumented)
+    if profile_path is not None:
+        instrument.start_profiling(profile_path, worker=True)
+    _job_generator = Generator(**options)
+
+def _job_stats() -> dict:
+    # Workers hand over what they recorded with each result, as they may not get a chance to later
+    instrument.dump_profile()
+    return instrument.snapshot(reset=True)
+
+def _html_job(profile: str) -> Tuple[str|None, dict|None, dict]:
+    error = _job_generator._build_html(profile)
+    return error, _job_generator.dependencies.entry(profile), _job_stats()
+
+def _pdf_job(profile: str) -> Tuple[str|None, dict]:
+    return _job_generator._build_pdf(profile), _job_stats()
 
 
 if __name__ == "__main__":
-    args = argparse.ArgumentParser()
+    args = arg_parser = argparse.ArgumentParser()
     args.add_argument("--continuous", action="store_true")
+    args.add_argument("--preview", type=int, nargs="?", const=8000, metavar="PORT", help="serve live-updating previews (implies --continuous)")
+    args.add_argument("--debounce", type=float, default=0.3, metavar="SECONDS", help="wait for changes to settle before regenerating in --continuous mode")
+    args.add_argument("--serve", type=int, nargs="?", const=8080, metavar="PORT", help="run as a daemon rendering posted profiles over HTTP (see server.py)")
+    args.add_argument("--bind", default="127.0.0.1", metavar="ADDRESS", help="address the --serve daemon listens on")
+    args.add_argument("--queue-size", type=int, default=32, metavar="N", help="requests the --serve daemon queues beyond the --jobs it renders at once, before refusing more")
+    args.add_argument("--no-pdf", action="store_true", help="don't start a PDF backend in the --serve daemon")
     args.add_argument("--test", action="store_true")
+    args.add_argument("--jobs", "-j", type=int, default=1, metavar="N", help="number of profiles generated in parallel")
+    args.add_argument("--assets", choices=Generator.ASSET_MODES, default="inline", help="inline fonts and images into each HTML file, or share them in output/assets")
+    args.add_argument("--subset-fonts", action="store_true", help="reduce embedded fonts to the glyphs each CV uses (requires fonttools)")
+    args.add_argument("--no-cache", action="store_true", help="don't keep build caches in output/.cache")
+    args.add_argument("--pdf-backend", choices=pdf.BACKENDS.keys(), default="selenium", help="print PDFs with a browser, or render them in-process with WeasyPrint")
+    args.add_argument("--browser", choices=browser.BACKENDS.keys(), default="edge")
+    args.add_argument("--browser-pool", type=int, default=None, metavar="N", help="number of browsers kept running (defaults to --jobs)")
+    args.add_argument("--browser-recycle", type=int, default=50, metavar="N", help="restart a browser after N PDFs")
+    args.add_argument("--profile-report", nargs="?", const="output/profile-report.json", metavar="PATH", help="print the time spent in each stage, and save it as JSON to PATH (default: %(const)s)")
+    args.add_argument("--cprofile", metavar="PATH", help="save a cProfile profile of the run to PATH, e.g. for snakeviz or pstats")
     args = args.parse_args()
+    if args.subset_fonts and not fonts.available():
+        arg_parser.error("--subset-fonts requires fonttools (pip install fonttools brotli)")
+    prints_pdf = not args.no_pdf if args.serve is not None else not args.continuous and args.preview is None
+    if prints_pdf and pdf.unavailable(args.pdf_backend):
+        arg_parser.error(pdf.unavailable(args.pdf_backend))
 
-    gen = Generator()
+    if args.no_cache:
+        cache.configure(None)
+    if args.profile_report is not None:
+        instrument.enable()
+    if args.cprofile:
+        instrument.start_profiling(args.cprofile)
+    gen = Generator(args.browser, args.browser_pool or args.jobs, args.browser_recycle, args.assets, args.subset_fonts, args.pdf_backend)
 
-    if args.continuous:
-        gen.generate_html()
-        observer = watchdog.observers.Observer()
-        handler = GenerateHandler(gen)
-        observer.schedule(handler, ".", recursive=True)
-        observer.start()
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            observer.stop()
-        observer.join()
-    else:
-        if gen.needs_update():
-            gen.generate_html()
-            gen.generate_pdf()
+    try:
+        if args.serve is not None:
+            import server
+            server.serve(gen, args.serve, args.bind, args.jobs, args.queue_size, not args.no_pdf)
+        elif args.continuous or args.preview is not None:
+            import watch
+            watch.run(gen, args.debounce, args.preview)
         else:
-            print("No changes detected...")
-        if args.test:
-            import test
-            for profile in gen.all_profiles():
-                test.run_all(profile)
+            stale = gen.stale_profiles()
+            if stale:
+                with instrument.timer("run.html"):
+                    gen.generate_html(jobs=args.jobs, profiles=stale)
+            if stale or gen.pdf_needs_update():
+                with instrument.timer("run.pdf"):
+                    gen.generate_pdf(jobs=args.jobs)
+            else:
+                print("No changes detected...")
+            if args.test:
+                import test
+                with instrument.timer("run.test"):
+                    test.run_many(gen.all_profiles(), jobs=args.jobs)
+    finally:
+        gen.close()
+        if args.cprofile:
+            instrument.finish_profiling()
+            print(f"Saved profile to {args.cprofile}")
+        if args.profile_report is not None:
+            report = instrument.snapshot()
+            print(instrument.summary(report))
+            instrument.write_report(args.profile_report, report)
+            print(f"Saved report to {args.profile_report}")
     print("Done.")
@@ -0,0 +1,190 @@
+"""
+Timers and counters for the stages of the generation pipeline.
+
+Instrumentation is off until `enable()` is called, and then costs a clock read per timed block.
+Timers are inclusive: a stage's time includes the stages nested in it, e.g. "template.render:index.html"
+includes the time of the templates it renders as modules.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List
+
+# cProfile and pstats are imported when profiling starts
+if TYPE_CHECKING:
+    import cProfile
+    import pstats
+
+ENABLED = False
+
+_lock = threading.Lock()
+_timers: Dict[str, List[float]] = {}
+_counters: Dict[str, int] = {}
+_profiler: "cProfile.Profile|None" = None
+_profile_path: str|None = None
+_profile_target: str|None = None
+
+
+def enable(enabled: bool = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = min(timer[2], seconds)
+            timer[3] = max(timer[3], seconds)
+
+
+def count(name: str, amount: int = 1):
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+def timer(name: str):
+    """
+    Times the block under `name`:
+
+        with instrument.timer("pdf.print"):
+            ...
+    """
+    return _Timer(name) if ENABLED else _NULL_TIMER
+
+
+def snapshot(reset: bool = False) -> dict:
+    """
+    The timers and counters recorded so far, in a form that can be serialized or passed to `merge`.
+    """
+    with _lock:
+        data = {
+            "timers": {name: {"count": t[0], "total": t[1], "min": t[2], "max": t[3]} for name, t in _timers.items()},
+            "counters": dict(_counters),
+        }
+        if reset:
+            _timers.clear()
+            _counters.clear()
+    return data
+
+
+def merge(data: dict):
+    """
+    Adds a snapshot, e.g. from a worker process, to the ones recorded here.
+    """
+    with _lock:
+        for name, t in data["timers"].items():
+            timer = _timers.get(name)
+            if timer is None:
+                _timers[name] = [t["count"], t["total"], t["min"], t["max"]]
+            else:
+                timer[0] += t["count"]
+                timer[1] += t["total"]
+                timer[2] = min(timer[2], t["min"])
+                timer[3] = max(timer[3], t["max"])
+        for name, value in data["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def summary(data: dict) -> str:
+    """
+    A human-readable table of a snapshot, slowest stages first.
+    """
+    lines = []
+    timers = sorted(data["timers"].items(), key=lambda item: item[1]["total"], reverse=True)
+    if timers:
+        width = max(len(name) for name, _ in timers)
+        lines.append(f"{'stage':<{width}}  {'count':>7}  {'total ms':>10}  {'mean ms':>9}  {'max ms':>9}")
+        for name, t in timers:
+            mean = t["total"] / t["count"] * 1000
+            lines.append(f"{name:<{width}}  {t['count']:>7}  {t['total'] * 1000:>10.1f}  {mean:>9.3f}  {t['max'] * 1000:>9.3f}")
+    counters = sorted(data["counters"].items())
+    if counters:
+        if lines:
+            lines.append("")
+        width = max(len(name) for name, _ in counters)
+        lines.extend(f"{name:<{width}}  {value:>7}" for name, value in counters)
+    return "\n".join(lines) if lines else "Nothing was recorded"
+
+
+def write_report(path: str, data: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(data, fh, indent=1, sort_keys=True)
+
+
+# cProfile capture. Worker processes dump their stats next to the main file, and `finish_profiling` combines them.
+
+
+def start_profiling(path: str, worker: bool = False):
+    """
+    Starts capturing a cProfile profile of this process, to be saved to `path`.
+    """
+    global _profiler, _profile_path, _profile_target
+    import cProfile
+    if _profiler is not None:
+        if not worker:
+            return
+        # Inherited from the main process through fork
+        _profiler.disable()
+    _profile_path = path
+    _profile_target = f"{path}.{os.getpid()}" if worker else path
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def profiling_path() -> str|None:
+    return _profile_path
+
+
+def dump_profile():
+    """
+    Saves what the profiler captured so far. It keeps running, so workers can call this after each job.
+    """
+    if _profiler is not None:
+        _profiler.create_stats()
+        _profiler.dump_stats(_profile_target)
+        _profiler.enable()
+
+
+def finish_profiling() -> "pstats.Stats|None":
+    """
+    Stops the profiler and saves its profile, merged with the profiles dumped by worker processes.
+    """
+    global _profiler, _profile_path
+    if _profiler is None:
+        return None
+    import pstats
+    _profiler.disable()
+    stats = pstats.Stats(_profiler)
+    directory, name = os.path.split(os.path.abspath(_profile_path))
+    for file in os.listdir(directory):
+        if file.startswith(name + ".") and file[len(name) + 1:].isdigit():
+            worker_path = os.path.join(directory, file)
+            stats.add(worker_path)
+            os.remove(worker_path)
+    stats.dump_stats(_profile_path)
+    _profiler = _profile_path = None
+    return stats
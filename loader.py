@@ -0,0 +1,232 @@
+"""
+Loads profiles from the input directory.
+
+Besides Python modules defining PROFILE, profiles can be declared as JSON, YAML or TOML documents
+mirroring the `model` dataclasses. Entries name their class with a "type" key, e.g.
+
+    {"name": "Jane Doe", "sections": [{"title": "Summary", "entries": [{"type": "text", "text": "..."}]}]}
+"""
+import dataclasses
+import functools
+import json
+import os
+import types
+import typing
+from typing import Any, Callable, Dict, List, Tuple
+
+import cache
+import deps
+import instrument
+import model
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+EXTENSIONS = (".py", ".json", ".yaml", ".yml", ".toml")
+
+_profiles = cache.LRUCache(max_entries=256)
+
+
+class ProfileError(ValueError):
+    pass
+
+
+def _entry_types(cls: type) -> Dict[str, type]:
+    entry_types = {}
+    for subclass in cls.__subclasses__():
+        if dataclasses.is_dataclass(subclass):
+            entry_types[subclass.TYPE] = subclass
+        entry_types.update(_entry_types(subclass))
+    return entry_types
+
+ENTRY_TYPES = _entry_types(model.BaseEntry)
+
+
+def _parse_py(source: bytes, path: str) -> model.Profile:
+    # Executed in a throwaway namespace rather than imported, so no module is kept around per profile
+    namespace = {"__name__": os.path.splitext(path)[0].replace(os.path.sep, "."), "__file__": path}
+    exec(compile(source, path, "exec"), namespace)
+    if not isinstance(namespace.get("PROFILE"), model.Profile):
+        raise ProfileError(f"{path}: PROFILE is not defined or not a Profile")
+    return namespace["PROFILE"]
+
+def _parse_json(source: bytes, path: str) -> Any:
+    return json.loads(source)
+
+def _parse_yaml(source: bytes, path: str) -> Any:
+    try:
+        import yaml
+    except ImportError:
+        raise ProfileError(f"{path}: YAML profiles require PyYAML (pip install pyyaml)")
+    return yaml.safe_load(source)
+
+def _parse_toml(source: bytes, path: str) -> Any:
+    if tomllib is None:
+        raise ProfileError(f"{path}: TOML profiles require Python 3.11 or tomli (pip install tomli)")
+    return tomllib.loads(source.decode("utf-8"))
+
+PARSERS: Dict[str, Callable[[bytes, str], Any]] = {
+    ".py": _parse_py,
+    ".json": _parse_json,
+    ".yaml": _parse_yaml,
+    ".yml": _parse_yaml,
+    ".toml": _parse_toml,
+}
+
+
+def _type_name(hint) -> str:
+    if hint is type(None):
+        return "null"
+    return getattr(hint, "__name__", None) or str(hint)
+
+
+def _matcher(hint) -> Callable[[Any], bool]:
+    """
+    Whether a parsed value has the shape of `hint`, which must not be a union.
+    """
+    if hint is type(None):
+        return lambda value: value is None
+    if typing.get_origin(hint) is list:
+        return lambda value: isinstance(value, list)
+    if dataclasses.is_dataclass(hint) or hint is model.BaseEntry:
+        return lambda value: isinstance(value, dict)
+    if hint is float:
+        return lambda value: type(value) in (int, float)
+    if hint is int:
+        # bool is a subclass of int, but not a valid int here
+        return lambda value: type(value) is int
+    return lambda value: isinstance(value, hint)
+
+
+@functools.lru_cache(maxsize=None)
+def _converter(hint) -> Callable[[Any, str], Any]:
+    """
+    A function which checks a parsed value against `hint` and turns it into model objects.
+    Built once per type, so loading doesn't inspect the annotations again.
+    """
+    origin = typing.get_origin(hint)
+    if origin is typing.Union or origin is types.UnionType:
+        options = [(_matcher(option), _converter(option)) for option in typing.get_args(hint)]
+        expected = " or ".join(_type_name(option) for option in typing.get_args(hint))
+        def convert_union(value, where: str):
+            for accepts, convert in options:
+                if accepts(value):
+                    return convert(value, where)
+            raise ProfileError(f"{where}: expected {expected}, got {type(value).__name__}")
+        return convert_union
+
+    accepts = _matcher(hint)
+    def check(value, where: str):
+        if not accepts(value):
+            raise ProfileError(f"{where}: expected {_type_name(hint)}, got {type(value).__name__}")
+
+    if origin is list:
+        convert_item = _converter(typing.get_args(hint)[0])
+        def convert_list(value, where: str):
+            check(value, where)
+            return [convert_item(item, f"{where}[{i}]") for i, item in enumerate(value)]
+        return convert_list
+    if hint is model.BaseEntry:
+        def convert_entry(value, where: str):
+            check(value, where)
+            entry_type = value.get("type")
+            if entry_type not in ENTRY_TYPES:
+                raise ProfileError(f"{where}.type: expected one of {', '.join(ENTRY_TYPES)}, got {entry_type!r}")
+            return _build(ENTRY_TYPES[entry_type], {k: v for k, v in value.items() if k != "type"}, where)
+        return convert_entry
+    if dataclasses.is_dataclass(hint):
+        def convert_dataclass(value, where: str):
+            check(value, where)
+            return _build(hint, value, where)
+        return convert_dataclass
+    if hint is float:
+        def convert_float(value, where: str):
+            check(value, where)
+            return float(value)
+        return convert_float
+    def convert_value(value, where: str):
+        check(value, where)
+        return value
+    return convert_value
+
+
+@functools.lru_cache(maxsize=None)
+def _schema(cls: type) -> Tuple[Dict[str, Callable[[Any, str], Any]], Tuple[str, ...]]:
+    """
+    Converters for the fields a dataclass is constructed with, and which of them are required.
+    """
+    hints = typing.get_type_hints(cls)
+    fields = [f for f in dataclasses.fields(cls) if f.init]
+    required = tuple(
+        f.name for f in fields
+        if f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING
+    )
+    return {f.name: _converter(hints[f.name]) for f in fields}, required
+
+
+def _build(cls: type, values: dict, where: str):
+    converters, required = _schema(cls)
+    unknown = [key for key in values if key not in converters]
+    if unknown:
+        raise ProfileError(f"{where}: unknown field{'s' if len(unknown) > 1 else ''} {', '.join(map(str, unknown))} for {cls.__name__}")
+    missing = [name for name in required if name not in values]
+    if missing:
+        raise ProfileError(f"{where}: missing {', '.join(missing)} for {cls.__name__}")
+    return cls(**{key: converters[key](value, f"{where}.{key}") for key, value in values.items()})
+
+
+def from_dict(data: Any, where: str = "profile") -> model.Profile:
+    """
+    Builds a profile from plain data, checking it against the model's type annotations.
+    """
+    return _converter(model.Profile)(data, where)
+
+
+def path(profile: str, directory: str = "input") -> str:
+    """
+    The file the profile is loaded from. Python modules take precedence over the other formats.
+    """
+    for extension in EXTENSIONS:
+        candidate = os.path.join(directory, profile + extension)
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"No profile named '{profile}' in {directory}")
+
+
+def names(directory: str = "input") -> List[str]:
+    """
+    The profiles in `directory`, sorted by name.
+    """
+    return sorted({
+        name for name, extension in map(os.path.splitext, os.listdir(directory))
+        if extension in EXTENSIONS and "template" not in name
+    })
+
+
+def load(profile_path: str) -> model.Profile:
+    """
+    Loads the profile at `profile_path`, choosing the format by its extension.
+
+    Parsed profiles are cached by the file's content hash, so unchanged files are neither parsed nor
+    executed again. The returned profiles are shared and frozen, so they must not be modified.
+    """
+    extension = os.path.splitext(profile_path)[1].lower()
+    if extension not in PARSERS:
+        raise ProfileError(f"{profile_path}: unsupported profile format (expected one of {', '.join(EXTENSIONS)})")
+    deps.track(profile_path)
+    with open(profile_path, "rb") as fh:
+        source = fh.read()
+    key = cache.digest(extension, source)
+    profile = _profiles.get(key)
+    if profile is None:
+        with instrument.timer(f"profile.parse{extension}"):
+            data = PARSERS[extension](source, profile_path)
+            profile = data if extension == ".py" else from_dict(data, profile_path)
+            profile.freeze()
+        _profiles.set(key, profile)
+    return profile
@@ -1,17 +1,72 @@
 import base64
-from dataclasses import dataclass
+import functools
+from dataclasses import dataclass, field
 from datetime import datetime
 import io
 import itertools
+import math
 import os
-import PIL.Image
 import re
-from typing import ClassVar, List
+from typing import Any, ClassVar, Dict, List, Tuple
+
+import cache
+import deps
+import instrument
+
+# Derived values
+
+
+class derived:
+    """
+    A read-only property which is computed on every access until the object is frozen, and only once after.
+    The class must have a `_derived` field.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        values = obj._derived
+        if values is None:
+            return self.func(obj)
+        if self.name not in values:
+            values[self.name] = self.func(obj)
+        return values[self.name]
+
+
+@functools.lru_cache(maxsize=None)
+def _derived_names(cls: type) -> Tuple[str, ...]:
+    return tuple(name for c in reversed(cls.__mro__) for name, value in vars(c).items() if isinstance(value, derived))
+
+
+def _freeze(obj):
+    names = _derived_names(type(obj))
+    if not names or obj._derived is not None:
+        return
+    values = {}
+    for name in names:
+        try:
+            values[name] = getattr(obj, name)
+        except Exception:
+            # Left to fail on access, as it would have without freezing
+            pass
+    obj._derived = values
+
+
+def _derived_field() -> Any:
+    return field(default=None, init=False, repr=False, compare=False)
+
 
 # Common types
 
 
-@dataclass
+MONTH_NAMES = ("",) + tuple(datetime(2000, month, 1).strftime("%b") for month in range(1, 13))
+
+
+@dataclass(slots=True)
 class Date:
     PRESENT: ClassVar[str] = "Present"
 
@@ -29,15 +84,16 @@ class Date:
 
     @property
     def month_name(self):
-        return datetime(2000, self.month, 1).strftime("%b") if self.month else ""
+        return MONTH_NAMES[self.month] if self.month else ""
 
 
-@dataclass
+@dataclass(slots=True)
 class WithDatePeriod:
     start_date: Date|str|None = None
     end_date: Date|str|None = None
+    _derived: Dict[str, Any]|None = _derived_field()
 
-    @property
+    @derived
     def date_range(self):
         start_str = str(self.start_date) if self.start_date else None
         end_str = str(self.end_date) if self.end_date else None
@@ -51,18 +107,31 @@ class WithDatePeriod:
 
 
 class BaseEntry:
+    __slots__ = ()
     TYPE: ClassVar[str] = "none"
 
+    def freeze(self):
+        """
+        Caches the entry's derived values. The entry must not be modified afterwards.
+        """
+        _freeze(self)
+        return self
+
 
-@dataclass
+@dataclass(slots=True)
 class Section:
     title: str
     column: int = 0
     columns_count: int = 1
     entries: List[BaseEntry]|None = None
 
+    def freeze(self):
+        for entry in self.entries or ():
+            entry.freeze()
+        return self
 
-@dataclass
+
+@dataclass(slots=True)
 class TextEntry(BaseEntry):
     """
     A simple text entry with optional bullets.
@@ -74,7 +143,7 @@ class TextEntry(BaseEntry):
     bullets: List[str]|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class QuoteEntry(BaseEntry):
     """
     A quote entry with optional author.
@@ -86,7 +155,7 @@ class QuoteEntry(BaseEntry):
     author: str|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ExperienceEntry(WithDatePeriod, BaseEntry):
     """
     A single experience entry with optional bullets.
@@ -102,7 +171,7 @@ class ExperienceEntry(WithDatePeriod, BaseEntry):
     bullets: List[str]|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SkillsEntry(BaseEntry):
     """
     A group of skills with optional title.
@@ -117,7 +186,7 @@ class SkillsEntry(BaseEntry):
     skills: List[str]|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SliderEntry(BaseEntry):
     """
     An entry with a slider and an optional title.
@@ -130,7 +199,7 @@ class SliderEntry(BaseEntry):
     value: float|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class IconAndTextEntry(BaseEntry):
     """
     General purpose entry with an icon, title and description (all optional).
@@ -144,13 +213,37 @@ class IconAndTextEntry(BaseEntry):
     description: str|None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class PieChartValue:
     name: str|None = None
     weight: float|None = None
 
 
-@dataclass
+@dataclass(slots=True)
+class PieChartSlice:
+    """
+    The geometry and colour of one slice of a pie chart, with points as (x, y) in a 200x200 view box.
+    """
+    letter: str
+    name: str|None
+    color: str
+    arc_radius: float
+    arc_start: Tuple[float, float]
+    arc_end: Tuple[float, float]
+    label_start: Tuple[float, float]
+    label_end: Tuple[float, float]
+    text_position: Tuple[float, float]
+    divider_start: Tuple[float, float]
+    divider_end: Tuple[float, float]
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_rgb(color: str) -> Tuple[int, int, int]|None:
+    match = re.match(PieChartEntry.RGB_PATTERN, color)
+    return tuple(map(int, match.groups())) if match else None
+
+
+@dataclass(slots=True)
 class PieChartEntry(BaseEntry):
     """
     An entry with a pie chart and an optional title.
@@ -158,22 +251,41 @@ class PieChartEntry(BaseEntry):
     """
     TYPE = "pie_chart"
     values: List[PieChartValue]|None = None
+    _derived: Dict[str, Any]|None = _derived_field()
 
-    @property
+    @derived
     def total_weight(self):
         return sum(v.weight for v in self.values if v.weight is not None)
+
+    @derived
+    def max_weight(self):
+        return max(v.weight for v in self.values if v.weight is not None)
+
+    @derived
+    def cumulative_angles(self):
+        """
+        The angle each slice ends at, in radians clockwise from the top.
+        """
+        total_weight = self.total_weight
+        angles = []
+        weights_sum = 0
+        for value in self.values:
+            weights_sum += value.weight / total_weight if total_weight else 0
+            angles.append(self.PI * 2 * weights_sum)
+        return angles
     
     def normalized_weight(self, idx: int):
-        return self.values[idx].weight / self.total_weight if self.total_weight else 0
+        total_weight = self.total_weight
+        return self.values[idx].weight / total_weight if total_weight else 0
     
     RGB_PATTERN = r"rgb\((\d+), (\d+), (\d+)\)"
     def lerp_color(self, a: str, b: str, idx: int):
-        a_match = re.match(self.RGB_PATTERN, a)
-        b_match = re.match(self.RGB_PATTERN, b)
-        w = self.values[idx].weight / max(v.weight for v in self.values if v.weight is not None)
-        if a_match and b_match:
-            ar, ag, ab = map(int, a_match.groups())
-            br, bg, bb = map(int, b_match.groups())
+        a_rgb = _parse_rgb(a)
+        b_rgb = _parse_rgb(b)
+        w = self.values[idx].weight / self.max_weight
+        if a_rgb and b_rgb:
+            ar, ag, ab = a_rgb
+            br, bg, bb = b_rgb
             r = int(ar + (br - ar) * w)
             g = int(ag + (bg - ag) * w)
             b = int(ab + (bb - ab) * w)
@@ -183,18 +295,100 @@ class PieChartEntry(BaseEntry):
         
     PI = 3.14159265358979323846
     def angles(self, idx: int):
-        weights = [self.normalized_weight(i) for i in range(idx + 1)]
-        weights_before = sum(weights[:idx])
-        weights_after = sum(weights)
-        angle_start = self.PI * 2 * weights_before
-        angle_end = self.PI * 2 * weights_after
-        return angle_start, angle_end
+        angles = self.cumulative_angles
+        angle_start = angles[idx - 1] if idx > 0 else self.PI * 2 * 0
+        return angle_start, angles[idx]
+
+    def layout(self, radius: float, width: float, start_color: str, end_color: str) -> List[PieChartSlice]:
+        """
+        The slices of a ring of the given outer radius and width, centered in a 200x200 view box,
+        coloured from `start_color` (no weight) to `end_color` (the largest weight).
+
+        Computed in a single pass over the values, and only once per arguments when the entry is frozen.
+        """
+        key = f"layout({radius}, {width}, {start_color}, {end_color})"
+        if self._derived is not None and key in self._derived:
+            return self._derived[key]
+        arc_radius = radius - width / 2
+        outer_radius = radius + width / 2
+        inner_radius = radius - width
+        slices = []
+        angle_start = self.PI * 2 * 0
+        sin_start, cos_start = math.sin(angle_start), math.cos(angle_start)
+        for i, (value, angle_end) in enumerate(zip(self.values, self.cumulative_angles)):
+            sin_end, cos_end = math.sin(angle_end), math.cos(angle_end)
+            angle_mid = (angle_start + angle_end) / 2
+            sin_mid, cos_mid = math.sin(angle_mid), math.cos(angle_mid)
+            slices.append(PieChartSlice(
+                letter=chr(ord("A") + i),
+                name=value.name,
+                color=self.lerp_color(start_color, end_color, i),
+                arc_radius=arc_radius,
+                arc_start=(100 + sin_start * arc_radius, 100 - cos_start * arc_radius),
+                arc_end=(100 + sin_end * arc_radius, 100 - cos_end * arc_radius),
+                label_start=(100 + sin_mid * arc_radius, 100 - cos_mid * arc_radius),
+                label_end=(100 + sin_mid * outer_radius, 100 - cos_mid * outer_radius),
+                text_position=(100 + sin_mid * outer_radius - 4, 100 - cos_mid * outer_radius + 4),
+                divider_start=(100 + sin_start * inner_radius, 100 - cos_start * inner_radius),
+                divider_end=(100 + sin_start * radius, 100 - cos_start * radius),
+            ))
+            angle_start, sin_start, cos_start = angle_end, sin_end, cos_end
+        if self._derived is not None:
+            self._derived[key] = slices
+        return slices
 
 
 # Profile
 
 
-@dataclass
+PHOTO_FORMATS = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+_thumbnail_cache = cache.LRUCache(max_entries=256, max_size=32 * 1024 * 1024)
+_thumbnail_disk = cache.DiskCache("photos")
+
+def _encode_thumbnail(path: str, size: int, format: str, quality: int, optimize: bool) -> bytes:
+    # Imported here, as most runs find their thumbnails cached
+    import PIL.Image
+    with open(path, "rb") as fh:
+        image = PIL.Image.open(fh)
+        image.thumbnail((size, size))
+        image = image.convert("RGB")
+    options = {"quality": quality}
+    if optimize:
+        if format == "JPEG":
+            options.update(optimize=True, progressive=True)
+        else:
+            options.update(method=6)
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+def thumbnail_base64(path: str, size: int = 200, format: str = "JPEG", quality: int = 75, optimize: bool = False):
+    """
+    A thumbnail of the image as a data URI.
+
+    Thumbnails are cached in memory and on disk by the image's content hash and the thumbnail parameters.
+    """
+    deps.track(path)
+    format = format.upper()
+    if format not in PHOTO_FORMATS:
+        raise ValueError(f"Unsupported photo format '{format}' (expected one of {', '.join(PHOTO_FORMATS)})")
+    key = cache.digest(cache.file_digest(path), str(size), format, str(quality), str(optimize))
+    data_uri = _thumbnail_cache.get(key)
+    if data_uri is None:
+        data = _thumbnail_disk.get(key)
+        if data is None:
+            with instrument.timer("photo.thumbnail"):
+                data = _encode_thumbnail(path, size, format, quality, optimize)
+            _thumbnail_disk.set(key, data)
+        data_uri = f"data:{PHOTO_FORMATS[format]};base64," + base64.b64encode(data).decode("utf-8")
+        _thumbnail_cache.set(key, data_uri)
+    return data_uri
+
+
+@dataclass(slots=True)
 class Profile:
     name: str|None = None
     title: str|None = None
@@ -212,20 +406,39 @@ class Profile:
     location: str|None = None
     link: str|None = None
     photo_file: str|None = None
+    photo_size: int = 200
+    photo_format: str = "JPEG"
+    photo_quality: int = 75
+    photo_optimize: bool = False
     sections: List[Section]|None = None
-
-    @property
+    _derived: Dict[str, Any]|None = _derived_field()
+
+    def freeze(self):
+        """
+        Caches the derived values of the profile and its entries. The profile must not be modified afterwards.
+        """
+        for section in self.sections or ():
+            section.freeze()
+        _freeze(self)
+        return self
+
+    @derived
     def first_name(self):
         return self.name.split(" ")[0]
     
-    @property
+    @derived
     def last_name(self):
         return " ".join(self.name.split(" ")[1:])
 
     @property
     def has_photo(self):
+        # Checked on every access rather than derived, as loaded profiles are shared across rebuilds, which must
+        # notice a photo being added or removed
         path = self.photo_path
-        return path is not None and os.path.exists(path)
+        if path is None:
+            return False
+        deps.track(path)
+        return os.path.exists(path)
 
     @property
     def photo_path(self):
@@ -235,17 +448,26 @@ class Profile:
     @property
     def photo_base64(self):
         path = self.photo_path
-        if path and os.path.exists(path):
-            with open(self.photo_path, "rb") as fh:
-                image = PIL.Image.open(fh)
-                image.thumbnail((200, 200))
-                image = image.convert("RGB")
-            buffer = io.BytesIO()
-            image.save(buffer, format="JPEG")
-            b64 = base64.b64encode(buffer.getvalue())
-            return "data:image/jpeg;base64," + b64.decode("utf-8")
+        if not path:
+            return None
+        try:
+            return thumbnail_base64(path, self.photo_size, self.photo_format, self.photo_quality, self.photo_optimize)
+        except FileNotFoundError:
+            return None
     
-    @property
+    @derived
+    def asset_paths(self) -> List[str]:
+        """
+        The files the profile references, besides templates and their includes.
+        """
+        paths = []
+        if self.photo_path:
+            paths.append(self.photo_path)
+        if self.page_image:
+            paths.append(os.path.join("includes", self.page_image))
+        return paths
+
+    @derived
     def sections_by_column(self):
         by_column = sorted(self.sections, key=lambda s: s.column)
-        return itertools.groupby(by_column, key=lambda s: s.column)
+        return [(column, list(sections)) for column, sections in itertools.groupby(by_column, key=lambda s: s.column)]
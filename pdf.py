@@ -0,0 +1,109 @@
+import abc
+import base64
+import importlib.util
+import os
+from typing import TYPE_CHECKING, Callable, ClassVar, Dict
+
+# Backends import what they print with when they're created, so choosing one doesn't load the others
+if TYPE_CHECKING:
+    import browser
+
+
+class PdfBackend(abc.ABC):
+    """
+    Converts generated HTML files to PDF.
+    """
+    name: ClassVar[str]
+    # Whether batches run on a thread pool sharing this backend, or on a process pool with one backend each
+    executor: ClassVar[str] = "threads"
+
+    @classmethod
+    def unavailable(cls) -> str|None:
+        """
+        Why the backend can't be created here, if that can be told without creating it.
+        """
+        return None
+
+    @abc.abstractmethod
+    def print_pdf(self, html_path: str) -> bytes:
+        pass
+
+    def close(self):
+        pass
+
+
+class SeleniumBackend(PdfBackend):
+    """
+    Prints pages with a browser leased from a pool.
+    """
+    name = "selenium"
+    browsers: "browser.BrowserPool"
+
+    def __init__(self, browsers: "browser.BrowserPool"):
+        self.browsers = browsers
+
+    def print_pdf(self, html_path: str) -> bytes:
+        from selenium.webdriver.common.print_page_options import PrintOptions
+        with self.browsers.lease() as driver:
+            driver.get("file://" + os.path.abspath(html_path))
+            options = PrintOptions()
+            options.orientation = "portrait"
+            # A4 in cm
+            options.page_width = 21.0
+            options.page_height = 29.7
+            # cm
+            options.margin_bottom = 0.0
+            options.margin_top = 0.0
+            options.margin_left = 0.0
+            options.margin_right = 0.0
+            options.scale = 1.0
+            pdf = driver.print_page(options)
+        return base64.b64decode(pdf)
+
+
+class WeasyPrintBackend(PdfBackend):
+    """
+    Renders pages in-process with WeasyPrint, without a browser.
+    """
+    name = "weasyprint"
+    executor = "processes"
+    # Same page setup as the browser's print options
+    PAGE_CSS = "@page { size: A4 portrait; margin: 0; }"
+    REQUIREMENT = "The weasyprint PDF backend requires weasyprint (pip install weasyprint)"
+
+    @classmethod
+    def unavailable(cls) -> str|None:
+        return cls.REQUIREMENT if importlib.util.find_spec("weasyprint") is None else None
+
+    def __init__(self):
+        try:
+            import weasyprint
+        except ImportError:
+            raise RuntimeError(self.REQUIREMENT)
+        self._weasyprint = weasyprint
+        self._page_css = weasyprint.CSS(string=self.PAGE_CSS)
+
+    def print_pdf(self, html_path: str) -> bytes:
+        document = self._weasyprint.HTML(filename=html_path)
+        return document.write_pdf(stylesheets=[self._page_css])
+
+
+BACKENDS: Dict[str, Callable[..., PdfBackend]] = {
+    SeleniumBackend.name: lambda gen: SeleniumBackend(gen.browsers),
+    WeasyPrintBackend.name: lambda gen: WeasyPrintBackend(),
+}
+_CLASSES: Dict[str, type] = {cls.name: cls for cls in (SeleniumBackend, WeasyPrintBackend)}
+
+
+def unavailable(name: str) -> str|None:
+    """
+    Why the named backend can't be used, or None if it may be.
+    """
+    cls = _CLASSES.get(name)
+    return cls.unavailable() if cls is not None else None
+
+
+def create(name: str, gen) -> PdfBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown PDF backend '{name}' (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name](gen)
@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import re
+from typing import Dict, List, Tuple
+import tornado.escape
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.web
+
+import cache
+import template
+
+# Top-level blocks of a document which are updated in place, in document order
+FRAGMENT_RE = re.compile(r"<header>.*?</header>|<section class=\"section\">.*?</section>", re.DOTALL)
+FRAGMENT_SELECTOR = "header, section.section"
+
+LIVE_RELOAD_SCRIPT = """<script>
+(function() {
+    var source = new EventSource("/events/%(profile)s?version=%(version)d");
+    source.onmessage = function(event) {
+        var message = JSON.parse(event.data);
+        if (message.type !== "fragments") {
+            location.reload();
+            return;
+        }
+        var targets = document.querySelectorAll("%(selector)s");
+        message.fragments.forEach(function(fragment) {
+            targets[fragment[0]].outerHTML = fragment[1];
+        });
+    };
+})();
+</script>
+"""
+
+
+def asset_url(path: str) -> str:
+    version = cache.file_digest(os.path.join("includes", path))[:12]
+    return f"/includes/{tornado.escape.url_escape(path, plus=False)}?v={version}"
+
+
+def split_fragments(html: str) -> Tuple[str, List[str]]:
+    """
+    Splits a document into its fragments and everything around them.
+    """
+    return FRAGMENT_RE.sub("", html), FRAGMENT_RE.findall(html)
+
+
+class Preview:
+    """
+    The latest preview of each profile, and the update which led to it.
+
+    Previews reference includes by URL instead of inlining them.
+    Updates carry only the fragments which changed, or ask for a reload when anything else did.
+    """
+    _documents: Dict[str, str]
+    _versions: Dict[str, int]
+    _updates: Dict[str, dict]
+
+    def __init__(self, gen, loop: tornado.ioloop.IOLoop):
+        self.gen = gen
+        self.loop = loop
+        self.updated = tornado.locks.Condition()
+        self._documents = {}
+        self._versions = {}
+        self._updates = {}
+
+    def render(self, profile: str) -> str:
+        profile_data = self.gen.get_profile(profile)
+        return template.render(f"templates/{profile_data.template}", profile_data, asset_url)
+
+    def page(self, profile: str) -> Tuple[int, str]:
+        if profile not in self._documents:
+            self._documents[profile] = self.render(profile)
+            self._versions[profile] = self._versions.get(profile, 0) + 1
+        return self._versions[profile], self._documents[profile]
+
+    def version(self, profile: str) -> int:
+        return self._versions.get(profile, 0)
+
+    def update(self, profile: str, since: int) -> dict:
+        update = self._updates.get(profile)
+        version = self.version(profile)
+        if update is None or version != since + 1:
+            return {"type": "reload", "version": version}
+        return update
+
+    def changed(self, profile: str):
+        """
+        Renders the profile again and notifies its clients. Can be called from any thread.
+        """
+        try:
+            html = self.render(profile)
+        except Exception as e:
+            print(f"[{profile}] Failed to update preview: {e}")
+            return
+        self.loop.add_callback(self._publish, profile, html)
+
+    def _publish(self, profile: str, html: str):
+        old_html = self._documents.get(profile)
+        if old_html == html:
+            return
+        version = self.version(profile) + 1
+        update = {"type": "reload", "version": version}
+        if old_html is not None:
+            old_shell, old_fragments = split_fragments(old_html)
+            shell, fragments = split_fragments(html)
+            if old_shell == shell and len(old_fragments) == len(fragments):
+                update = {
+                    "type": "fragments",
+                    "version": version,
+                    "fragments": [[i, f] for i, (old_f, f) in enumerate(zip(old_fragments, fragments)) if old_f != f],
+                }
+        self._documents[profile] = html
+        self._versions[profile] = version
+        self._updates[profile] = update
+        self.updated.notify_all()
+
+
+class IndexHandler(tornado.web.RequestHandler):
+    def initialize(self, preview: Preview):
+        self.preview = preview
+
+    def get(self):
+        self.write("<!DOCTYPE html><html><body><ul>")
+        for profile in self.preview.gen.all_profiles():
+            name = tornado.escape.xhtml_escape(profile)
+            self.write(f"<li><a href=\"/{tornado.escape.url_escape(profile)}\">{name}</a></li>")
+        self.write("</ul></body></html>")
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    def initialize(self, preview: Preview):
+        self.preview = preview
+
+    def get(self, profile: str):
+        if profile not in self.preview.gen.all_profiles():
+            raise tornado.web.HTTPError(404)
+        version, html = self.preview.page(profile)
+        script = LIVE_RELOAD_SCRIPT % {
+            "profile": tornado.escape.url_escape(profile),
+            "version": version,
+            "selector": FRAGMENT_SELECTOR,
+        }
+        body_end = html.rfind("</body>")
+        if body_end < 0:
+            body_end = len(html)
+        self.set_header("Cache-Control", "no-cache")
+        self.write(html[:body_end] + script + html[body_end:])
+
+
+class EventsHandler(tornado.web.RequestHandler):
+    KEEPALIVE = datetime.timedelta(seconds=15)
+
+    def initialize(self, preview: Preview):
+        self.preview = preview
+
+    async def get(self, profile: str):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        last_event_id = self.request.headers.get("Last-Event-ID")
+        version = int(last_event_id or self.get_argument("version", "0"))
+        try:
+            while True:
+                current = self.preview.version(profile)
+                if current != version:
+                    update = self.preview.update(profile, version)
+                    self.write(f"id: {update['version']}\ndata: {json.dumps(update)}\n\n")
+                    version = update["version"]
+                else:
+                    self.write(": keepalive\n\n")
+                await self.flush()
+                await self.preview.updated.wait(timeout=self.KEEPALIVE)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+def serve(gen, handler, port: int):
+    """
+    Serves live previews of all profiles, updated whenever `handler` regenerates a profile.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    preview = Preview(gen, loop)
+    handler.on_generated = preview.changed
+    app = tornado.web.Application([
+        (r"/", IndexHandler, {"preview": preview}),
+        (r"/events/([^/]+)", EventsHandler, {"preview": preview}),
+        (r"/includes/(.*)", tornado.web.StaticFileHandler, {"path": "includes"}),
+        (r"/([^/]+)", ProfileHandler, {"preview": preview}),
+    ])
+    app.listen(port)
+    print(f"Previewing at http://localhost:{port}/")
+    loop.start()
@@ -0,0 +1,284 @@
+"""
+A long-running daemon rendering CVs on request, with templates, assets and browsers kept warm between requests.
+
+    POST /render/html   profile JSON in, HTML out
+    POST /render/pdf    profile JSON in, PDF out
+    GET  /health        whether the daemon is up, and how busy it is
+    GET  /metrics       request counters, queue state and per-stage timings
+
+Profiles are posted in the format of JSON profiles in input (see loader.py). Photos and page images are
+referenced by name, and resolved in input and includes as usual.
+"""
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+import tornado.ioloop
+import tornado.web
+
+import instrument
+import loader
+import model
+import template
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ApiError(tornado.web.HTTPError):
+    """
+    An error response, whose message is sent to the client as JSON.
+    """
+    def __init__(self, status_code: int, message: str, headers: Dict[str, str]|None = None):
+        super().__init__(status_code)
+        self.message = message
+        self.headers = headers or {}
+
+
+class RenderQueue:
+    """
+    Runs render jobs on `workers` threads, with at most `max_queued` more jobs waiting for one.
+    Jobs beyond that are refused, so callers can back off instead of piling up requests.
+    """
+    workers: int
+    max_queued: int
+    # Jobs accepted and not finished yet, running or waiting. Only changed on the IOLoop thread.
+    pending: int
+    running: int
+
+    def __init__(self, workers: int = 1, max_queued: int = 32):
+        self.workers = max(1, workers)
+        self.max_queued = max(0, max_queued)
+        self.pending = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.pending - self.running)
+
+    def full(self) -> bool:
+        return self.pending >= self.workers + self.max_queued
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        if self.full():
+            raise QueueFull()
+        self.pending += 1
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(self._executor, self._run, func, *args)
+        finally:
+            self.pending -= 1
+
+    def _run(self, func: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class RenderServer:
+    """
+    Renders posted profiles with the generator's options and PDF backend.
+    """
+    WORK_DIR = os.path.join("output", ".server")
+
+    def __init__(self, gen, queue: RenderQueue):
+        self.gen = gen
+        self.queue = queue
+        self.started = time.time()
+        self.pdf_error = None
+
+    def templates(self) -> List[str]:
+        return sorted(name for name in os.listdir("templates") if os.path.isdir(os.path.join("templates", name)))
+
+    @staticmethod
+    def _inside(directory: str, name: str) -> bool:
+        root = os.path.realpath(directory)
+        return os.path.commonpath([root, os.path.realpath(os.path.join(directory, name))]) == root
+
+    def parse(self, body: bytes) -> model.Profile:
+        """
+        The posted profile. Raises `loader.ProfileError` if it's invalid or references files it shouldn't.
+        """
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise loader.ProfileError(f"profile: invalid JSON: {e}")
+        profile = loader.from_dict(data)
+        # The model allows these to be left out, but the templates need them
+        if not profile.name:
+            raise loader.ProfileError("profile.name: required")
+        if profile.sections is None:
+            profile.sections = []
+        for i, section in enumerate(profile.sections):
+            self._complete_section(section, f"profile.sections[{i}]")
+        if profile.template not in self.templates():
+            raise loader.ProfileError(f"profile.template: unknown template {profile.template!r}")
+        if profile.photo_file and not self._inside("input", profile.photo_file):
+            raise loader.ProfileError("profile.photo_file: must name a file in input")
+        if profile.page_image and not self._inside("includes", profile.page_image):
+            raise loader.ProfileError("profile.page_image: must name a file in includes")
+        return profile.freeze()
+
+    @staticmethod
+    def _complete_section(section: model.Section, where: str):
+        """
+        Fills in the lists the model allows to be left out, and rejects pie charts the templates can't lay out.
+        """
+        if section.entries is None:
+            section.entries = []
+        for i, entry in enumerate(section.entries):
+            if isinstance(entry, model.SkillsEntry) and entry.skills is None:
+                entry.skills = []
+            if not isinstance(entry, model.PieChartEntry):
+                continue
+            if entry.values is None:
+                entry.values = []
+            for j, value in enumerate(entry.values):
+                if value.weight is None or value.weight < 0:
+                    raise loader.ProfileError(f"{where}.entries[{i}].values[{j}].weight: required, and must not be negative")
+            if entry.values and not any(value.weight > 0 for value in entry.values):
+                raise loader.ProfileError(f"{where}.entries[{i}].values: at least one weight must be positive")
+
+    def render_html(self, profile: model.Profile) -> bytes:
+        with instrument.timer("server.render.html"):
+            return template.render(f"templates/{profile.template}", profile, subset_fonts=self.gen.subset_fonts).encode("utf-8")
+
+    def render_pdf(self, profile: model.Profile) -> bytes:
+        with instrument.timer("server.render.pdf"):
+            # PDF backends print from a file
+            os.makedirs(self.WORK_DIR, exist_ok=True)
+            fd, html_path = tempfile.mkstemp(suffix=".html", dir=self.WORK_DIR)
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    template.render_to(fh, f"templates/{profile.template}", profile, subset_fonts=self.gen.subset_fonts)
+                with instrument.timer("pdf.print"):
+                    return self.gen.pdf_printer.print_pdf(html_path)
+            finally:
+                os.remove(html_path)
+
+    def warm_up(self, pdf_enabled: bool):
+        """
+        Compiles the templates, loads the includes they inline and starts the PDF backend, so the first requests
+        don't pay for it.
+        """
+        for name in self.templates():
+            try:
+                template.render(f"templates/{name}", model.Profile(name="Warm Up", template=name, sections=[]), subset_fonts=self.gen.subset_fonts)
+            except Exception as e:
+                print(f"Failed to warm up template '{name}': {e}")
+        if not pdf_enabled:
+            self.pdf_error = "PDF rendering is disabled"
+            return
+        try:
+            printer = self.gen.pdf_printer
+            if printer.name == "selenium":
+                self.gen.browsers.start()
+        except Exception as e:
+            self.pdf_error = f"PDF backend '{self.gen.pdf_backend}' is unavailable: {e}"
+            print(self.pdf_error)
+
+    def status(self) -> dict:
+        return {
+            "status": "ok",
+            "uptime": round(time.time() - self.started, 3),
+            "workers": self.queue.workers,
+            "running": self.queue.running,
+            "queued": self.queue.queued,
+            "max_queued": self.queue.max_queued,
+            "pdf": self.pdf_error is None,
+        }
+
+
+class JsonErrorHandler(tornado.web.RequestHandler):
+    def initialize(self, server: RenderServer):
+        self.server = server
+
+    def write_error(self, status_code: int, **kwargs):
+        error = kwargs.get("exc_info", (None, None))[1]
+        if not isinstance(error, ApiError):
+            self.finish({"error": self._reason})
+            return
+        for name, value in error.headers.items():
+            self.set_header(name, value)
+        self.finish({"error": error.message})
+
+
+class RenderHandler(JsonErrorHandler):
+    CONTENT_TYPES = {
+        "html": "text/html; charset=utf-8",
+        "pdf": "application/pdf",
+    }
+
+    async def post(self, kind: str):
+        instrument.count(f"server.requests.{kind}")
+        if kind == "pdf" and self.server.pdf_error is not None:
+            instrument.count("server.failed")
+            raise ApiError(501, self.server.pdf_error)
+        try:
+            profile = self.server.parse(self.request.body)
+        except loader.ProfileError as e:
+            instrument.count("server.invalid")
+            raise ApiError(400, str(e))
+        render = self.server.render_pdf if kind == "pdf" else self.server.render_html
+        try:
+            with instrument.timer(f"server.request.{kind}"):
+                result = await self.server.queue.run(render, profile)
+        except QueueFull:
+            instrument.count("server.rejected")
+            raise ApiError(503, "The render queue is full", {"Retry-After": "1"})
+        except Exception as e:
+            instrument.count("server.failed")
+            raise ApiError(500, f"Failed to render {kind.upper()}: {e}")
+        instrument.count("server.completed")
+        self.set_header("Content-Type", self.CONTENT_TYPES[kind])
+        self.write(result)
+
+
+class HealthHandler(JsonErrorHandler):
+    def get(self):
+        self.set_header("Cache-Control", "no-cache")
+        self.write(self.server.status())
+
+
+class MetricsHandler(JsonErrorHandler):
+    def get(self):
+        self.set_header("Cache-Control", "no-cache")
+        self.write({**self.server.status(), **instrument.snapshot()})
+
+
+def make_app(server: RenderServer) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/render/(html|pdf)", RenderHandler, {"server": server}),
+        (r"/health", HealthHandler, {"server": server}),
+        (r"/metrics", MetricsHandler, {"server": server}),
+    ])
+
+
+def serve(gen, port: int, address: str = "127.0.0.1", workers: int = 1, max_queued: int = 32, pdf_enabled: bool = True, max_body_size: int = 1024 * 1024):
+    """
+    Serves the render API until interrupted.
+    """
+    instrument.enable()
+    queue = RenderQueue(workers, max_queued)
+    server = RenderServer(gen, queue)
+    server.warm_up(pdf_enabled)
+    make_app(server).listen(port, address, max_body_size=max_body_size)
+    print(f"Serving the render API at http://{address}:{port}/ ({queue.workers} workers, {queue.max_queued} queued)")
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
@@ -1,20 +1,144 @@
 import base64
+import dataclasses
+import functools
+import io
+import marshal
 import math
 import os
 import re
-import time
-import tornado.web
+import shutil
+import sys
+import tornado
+import tornado.escape
 import tornado.template
-from typing import Callable, List, Tuple
+import tornado.util
+import tornado.web
+from typing import BinaryIO, Callable, ClassVar, Dict, List, Tuple
+
+import cache
+import deps
+import fonts
+import instrument
+
+
+_b64_cache = cache.LRUCache(max_entries=64, max_size=64 * 1024 * 1024)
+_b64_disk = cache.DiskCache("b64")
+
+def include_b64(path: str):
+    full_path = os.path.join("includes", path)
+    deps.track(full_path)
+    stat = os.stat(full_path)
+    key = (os.path.abspath(full_path), stat.st_mtime_ns, stat.st_size)
+    b64 = _b64_cache.get(key)
+    if b64 is None:
+        disk_key = cache.digest(*map(str, key))
+        data = _b64_disk.get(disk_key)
+        if data is None:
+            instrument.count("base64.encoded")
+            with open(full_path, "rb") as fh:
+                data = base64.b64encode(fh.read())
+            _b64_disk.set(disk_key, data)
+        b64 = data.decode("utf-8")
+        _b64_cache.set(key, b64)
+    return b64
+
+
+ASSETS_DIR = os.path.join("output", "assets")
+
+def _bundle_path(name: str, digest: str) -> Tuple[str, str]:
+    stem, ext = os.path.splitext(os.path.basename(name))
+    bundled_name = f"{stem}.{digest[:12]}{ext}"
+    return os.path.join(ASSETS_DIR, bundled_name), "assets/" + tornado.escape.url_escape(bundled_name, plus=False)
+
+def bundle_asset(path: str) -> str:
+    """
+    Copies a file from the includes directory into the shared asset bundle, under a content-hashed name.
+    Returns its URL relative to the output directory.
+    """
+    full_path = os.path.join("includes", path)
+    bundle_path, url = _bundle_path(path, cache.file_digest(full_path))
+    if not os.path.exists(bundle_path):
+        os.makedirs(ASSETS_DIR, exist_ok=True)
+        with open(full_path, "rb") as src, cache.atomic_open(bundle_path) as dst:
+            shutil.copyfileobj(src, dst)
+    return url
+
+def bundle_data(name: str, data: bytes) -> str:
+    """
+    Like bundle_asset, but for generated contents.
+    """
+    bundle_path, url = _bundle_path(name, cache.digest(data))
+    if not os.path.exists(bundle_path):
+        os.makedirs(ASSETS_DIR, exist_ok=True)
+        with cache.atomic_open(bundle_path) as fh:
+            fh.write(data)
+    return url
 
 
 class B64Module(tornado.web.UIModule):
-    def render(self, path: str, **kwargs):
-        with open(os.path.join("includes", path), "rb") as fh:
-            return base64.b64encode(fh.read()).decode("utf-8")
+    """
+    URL of a file from the includes directory.
+
+    Files are inlined as base64 data URIs, unless the application has an "asset_url" setting.
+    """
+    def render(self, path: str, mime: str, **kwargs):
+        asset_url = self.handler.settings.get("asset_url")
+        if asset_url is not None:
+            deps.track(os.path.join("includes", path))
+            return asset_url(path)
+        with instrument.timer("base64.inline"):
+            return f"data:{mime};base64,{include_b64(path)}"
+
+
+class FontModule(B64Module):
+    """
+    CSS source of a font from the includes directory, as in `src: url(...) format(...)`.
+
+    With the "subset_fonts" setting, fonts are reduced to the glyphs the document uses once it's rendered:
+    icon fonts to the icons in use, other fonts to the characters of the text.
+    """
+    # A CSS comment, unique to the document, which can't be a prefix of another one or appear in its content
+    PLACEHOLDER = "/*font-subset:{token}:{index}*/"
+
+    _subsets: List[Tuple[str, bool]]
+
+    def __init__(self, handler):
+        super().__init__(handler)
+        self._subsets = []
+        self._token = os.urandom(8).hex()
+
+    def render(self, path: str, mime: str, format: str, icons: bool = False, **kwargs):
+        asset_url = self.handler.settings.get("asset_url")
+        # Previews serve the includes directory as it is
+        if self.handler.settings.get("subset_fonts") and asset_url in (None, bundle_asset):
+            placeholder = self.PLACEHOLDER.format(token=self._token, index=len(self._subsets))
+            self._subsets.append((path, icons))
+            return placeholder
+        return f"url({super().render(path, mime)}) format(\"{format}\")"
+
+    def finalize(self, html: bytes, css: bytes|None) -> Tuple[bytes, bytes|None]:
+        if not self._subsets:
+            return html, css
+        document = html + (css or b"")
+        codepoints = {}
+        sources = []
+        for path, icons in self._subsets:
+            if icons not in codepoints:
+                codepoints[icons] = fonts.icon_codepoints(document) if icons else fonts.text_codepoints(document)
+            data, flavor = fonts.subset(os.path.join("includes", path), codepoints[icons])
+            if self.handler.settings.get("asset_url") is None:
+                url = f"data:font/{flavor};base64," + base64.b64encode(data).decode("utf-8")
+            else:
+                url = bundle_data(os.path.splitext(path)[0] + "." + flavor, data)
+            sources.append(f"url({url}) format(\"{flavor}\")".encode("utf-8"))
+        placeholder_re = re.compile(rb"/\*font-subset:" + self._token.encode("ascii") + rb":(\d+)\*/")
+        html = placeholder_re.sub(lambda match: sources[int(match.group(1))], html)
+        return html, css
 
 
 class MarkdownModule(tornado.web.UIModule):
+    # Its output depends only on its arguments, so it can be part of cached fragments
+    PURE: ClassVar[bool] = True
     MDLINK_RE = re.compile(r"\[([^\]]+)\]\(([^\)]+)\)")
     MDBOLD_RE = re.compile(r"\*\*([^\*]+)\*\*")
     MDITALIC_RE = re.compile(r"\*([^\*]+)\*")
@@ -70,97 +194,319 @@ class MarkdownModule(tornado.web.UIModule):
     ]
 
     def render(self, text: str, **kwargs):
+        with instrument.timer("markdown"):
+            return self.transform(text)
+
+    def transform(self, text: str) -> str:
+        # Transformers are tried in order of priority, so the next match of each one is kept
+        # and only searched for again once the output position moves past its start.
+        # This way each pattern scans the text about once, instead of once per replacement.
+        matches: List[re.Match[str]|None|bool] = [False] * len(self.TRANSFORMERS)
         result = []
-        while text:
-            for pattern, repl in self.TRANSFORMERS:
-                match = pattern.search(text)
+        pos = 0
+        while pos < len(text):
+            for i, (pattern, repl) in enumerate(self.TRANSFORMERS):
+                match = matches[i]
+                if match is False or (match is not None and match.start() < pos):
+                    match = matches[i] = pattern.search(text, pos)
                 if match:
-                    result.append(text[:match.start()])
+                    result.append(text[pos:match.start()])
                     if isinstance(repl, str):
-                        result.append(pattern.sub(repl, text, 1))
+                        result.append(match.expand(repl))
                     else:
                         result.append(repl(match))
-                    text = text[match.end():]
+                    pos = match.end()
                     break
             else:
-                result.append(text)
-                text = ""
+                result.append(text[pos:])
+                break
         return "".join(result)
 
 
 
+def fingerprint(value) -> str|None:
+    """
+    A representation of a value which changes whenever the value does, or None if it can't be made.
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        parts = [fingerprint(v) for v in value]
+        return None if None in parts else "[" + ", ".join(parts) + "]"
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        parts = [fingerprint(getattr(value, f.name)) for f in dataclasses.fields(value) if f.compare]
+        return None if None in parts else type(value).__qualname__ + "(" + ", ".join(parts) + ")"
+    return None
+
+
 class StylizedTemplateModule(tornado.web.TemplateModule):
+    """
+    Renders a template, moving its leading <style> block into the page's embedded CSS.
+
+    Rendered fragments are memoized when the template depends only on its arguments.
+    They are keyed by the template's content hash, the arguments and the `profile` fields the template reads,
+    so they are reused across renders and across profiles sharing the same entries.
+    """
     NEWLINES_RE = re.compile(rb"[\n]+")
+    PROFILE_RE = re.compile(rb"\bprofile\b")
+    PROFILE_FIELD_RE = re.compile(rb"\bprofile\.(\w+)")
+    MODULE_RE = re.compile(rb"{%\s*module\s+(\w+)")
+
+    fragments: ClassVar[cache.LRUCache] = cache.LRUCache(max_entries=4096, max_size=64 * 1024 * 1024, sizeof=lambda f: len(f[0]))
+    # The profile fields each template version reads, or None if its fragments can't be cached
+    _profile_fields: ClassVar[cache.LRUCache] = cache.LRUCache(max_entries=1024)
+    _UNKNOWN = object()
+
+    def _fragment_key(self, path: str, kwargs: dict) -> str|None:
+        loader = self.handler.settings["template_loader"]
+        template_key = loader.key(path)
+        fields = self._profile_fields.get(template_key, self._UNKNOWN)
+        if fields is self._UNKNOWN:
+            source, _ = loader.source(loader.resolve_path(path))
+            fields = None
+            # Modules whose output depends on anything but their arguments (settings, nested templates'
+            # resources) make the template uncacheable, unless they're marked PURE
+            modules = {name.decode("utf-8") for name in self.MODULE_RE.findall(source)}
+            if all(getattr(self.handler.UI_MODULES.get(name), "PURE", False) for name in modules):
+                used_fields = self.PROFILE_FIELD_RE.findall(source)
+                if len(used_fields) == len(self.PROFILE_RE.findall(source)):
+                    fields = tuple(sorted({f.decode("utf-8") for f in used_fields}))
+            self._profile_fields.set(template_key, fields)
+        if fields is None or (fields and "profile" not in kwargs):
+            return None
+        profile = kwargs.get("profile")
+        values = [(name, value) for name, value in sorted(kwargs.items()) if name != "profile"]
+        values += [(f"profile.{field}", getattr(profile, field)) for field in fields]
+        parts = [template_key, path]
+        for name, value in values:
+            value_fingerprint = fingerprint(value)
+            if value_fingerprint is None:
+                return None
+            parts.append(f"{name}={value_fingerprint}")
+        return cache.digest(*parts)
+
+    def _add_resource(self, path: str, css: str|None):
+        if css is not None and path not in self._resource_dict:
+            resource = {"embedded_css": css}
+            self._resource_list.append(resource)
+            self._resource_dict[path] = resource
+
     def render(self, path: str, **kwargs) -> bytes:
-        result = super().render(path, math=math, **kwargs)
+        if not instrument.ENABLED:
+            return self._render(path, **kwargs)
+        with instrument.timer(f"template.render:{path}"):
+            return self._render(path, **kwargs)
+
+    def _render(self, path: str, **kwargs) -> bytes:
+        key = self._fragment_key(path, kwargs)
+        if key is None:
+            instrument.count("template.fragments_uncacheable")
+        else:
+            fragment = self.fragments.get(key)
+            instrument.count("template.fragment_hits" if fragment is not None else "template.fragment_misses")
+            if fragment is not None:
+                result, css, dependencies = fragment
+                for dependency in dependencies:
+                    deps.track(dependency)
+                self._add_resource(path, css)
+                return result
+        with deps.recording() as dependencies:
+            result = super().render(path, math=math, **kwargs)
+        css = None
         if result.startswith(b"<style>"):
             css_end = result.find(b"</style>")
-            css = result[7:css_end]
+            css = result[7:css_end].decode("utf-8")
             result = result[css_end + 8:]
-            if path not in self._resource_dict:
-                resource = {"embedded_css": css.decode("utf-8")}
-                self._resource_list.append(resource)
-                self._resource_dict[path] = resource
+        self._add_resource(path, css)
         result = self.NEWLINES_RE.sub(b"\n", result)
+        if key is not None:
+            self.fragments.set(key, (result, css, tuple(dependencies)))
         return result
 
 
-class MockTornadoApplication(tornado.web.Application):
-    def __init__(self, path: str):
-        self.ui_methods = {}
-        self.ui_modules = {}
+class PrecompiledTemplate(tornado.template.Template):
+    """
+    A template restored from compiled code, without parsing its source.
+    """
+    def __init__(self, source: bytes, code: str, compiled, name: str, loader: tornado.template.BaseLoader):
+        self.name = name
+        self.autoescape = loader.autoescape
+        self.namespace = loader.namespace
+        self.loader = loader
+        self.source = source
+        self.code = code
+        self.compiled = compiled
+
+    def __getattr__(self, attr: str):
+        # Templates which extend or include this one need its parse tree
+        if attr == "file":
+            self.file = tornado.template.Template(self.source, self.name, self.loader).file
+            return self.file
+        raise AttributeError(attr)
+
+
+class CachingLoader(tornado.template.Loader):
+    """
+    A template loader which compiles each template once and only recompiles it when its contents change.
+
+    Templates are keyed by path and content hash (including extended/included templates).
+    Compiled code is also kept in the "templates" disk cache, so other processes can skip compilation.
+    """
+    DEPENDENCY_RE = re.compile(rb"{%\s*(?:extends|include)\s+[\"']([^\"']+)[\"']")
+
+    compile_count: int
+    _sources: Dict[str, Tuple[Tuple[int, int], bytes, str]]
+    _keys: Dict[str, str]
+
+    def __init__(self, root_directory: str, **kwargs):
+        super().__init__(root_directory, **kwargs)
+        self.compile_count = 0
+        self._sources = {}
+        self._keys = {}
+        self._disk = cache.DiskCache("templates")
+
+    def source(self, name: str) -> Tuple[bytes, str]:
+        path = os.path.join(self.root, name)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        entry = self._sources.get(name)
+        if entry is None or entry[0] != stamp:
+            with open(path, "rb") as fh:
+                source = fh.read()
+            entry = (stamp, source, cache.digest(source))
+            self._sources[name] = entry
+        return entry[1], entry[2]
+
+    def key(self, name: str) -> str:
+        deps.track(os.path.join(self.root, name))
+        source, key = self.source(name)
+        dependencies = self.DEPENDENCY_RE.findall(source)
+        if dependencies:
+            key = cache.digest(key, *(self.key(self.resolve_path(d.decode("utf-8"), name)) for d in dependencies))
+        return key
+
+    def _compile(self, name: str, key: str) -> tornado.template.Template:
+        source, _ = self.source(name)
+        disk_key = cache.digest(
+            os.path.abspath(os.path.join(self.root, name)), key,
+            str(self.autoescape), str(self.whitespace),
+            sys.version, tornado.version,
+        )
+        data = self._disk.get(disk_key)
+        if data is not None:
+            try:
+                code, compiled = marshal.loads(data)
+                instrument.count("template.compile_cache_hits")
+                return PrecompiledTemplate(source, code, compiled, name, self)
+            except (EOFError, ValueError, TypeError):
+                pass
+        self.compile_count += 1
+        instrument.count("template.compiled")
+        with instrument.timer("template.compile"):
+            template = tornado.template.Template(source, name=name, loader=self)
+        self._disk.set(disk_key, marshal.dumps((template.code, template.compiled)))
+        return template
+
+    def load(self, name: str, parent_path: str|None = None) -> tornado.template.Template:
+        name = self.resolve_path(name, parent_path=parent_path)
+        with self.lock:
+            key = self.key(name)
+            if self._keys.get(name) != key:
+                self.templates[name] = self._compile(name, key)
+                self._keys[name] = key
+            return self.templates[name]
+
+
+_loaders: Dict[str, CachingLoader] = {}
+
+def get_loader(path: str) -> CachingLoader:
+    loader = _loaders.get(path)
+    if loader is None:
+        loader = _loaders.setdefault(path, CachingLoader(path))
+    return loader
+
+
+class Renderer:
+    """
+    Renders templates from a directory along with their UI modules, without tornado's request handling.
+
+    Stands in for the request handler which UI modules are bound to, and collects their embedded CSS.
+    A renderer holds the resources of one document, so a new one is needed for each render.
+    """
+    UI_MODULES: ClassVar[Dict[str, type]] = {
+        "Template": StylizedTemplateModule,
+        "b64": B64Module,
+        "font": FontModule,
+        "md": MarkdownModule,
+    }
+
+    request = None
+    locale = None
+    current_user = None
+
+    def __init__(self, path: str, asset_url: Callable[[str], str]|None = None, subset_fonts: bool = False):
         self.settings = {
             "template_path": path,
-            "compiled_template_cache": False,
-            "debug": True,
-        }
-        self.ui_modules = {
-            "Template": StylizedTemplateModule,
-            "b64": B64Module,
-            "md": MarkdownModule,
+            "template_loader": get_loader(path),
+            "asset_url": asset_url,
+            "subset_fonts": subset_fonts,
         }
+        self.loader = self.settings["template_loader"]
+        self.ui = tornado.util.ObjectDict({
+            name: functools.partial(self._render_module, name)
+            for name in self.UI_MODULES
+        })
+        self._modules = {}
 
+    def _render_module(self, name: str, *args, **kwargs) -> str:
+        module = self._modules.get(name)
+        if module is None:
+            module = self._modules[name] = self.UI_MODULES[name](self)
+        return tornado.escape.to_unicode(module.render(*args, **kwargs))
 
-class MockTornadoConnection:
-    content: bytes = b""
+    def render_string(self, name: str, **kwargs) -> bytes:
+        namespace = {
+            "handler": self,
+            "modules": self.ui,
+            "_tt_modules": self.ui,
+        }
+        namespace.update(kwargs)
+        return self.loader.load(name).generate(**namespace)
 
-    def set_close_callback(*args, **kwargs):
-        pass
+    def embedded_css(self) -> bytes|None:
+        css = [module.embedded_css() for module in self._modules.values()]
+        css = [tornado.escape.utf8(part) for part in css if part]
+        if css:
+            return b'<style type="text/css">\n' + b"\n".join(css) + b"\n</style>\n"
 
-    def write_headers(self, start_line, headers, chunk: bytes):
-        self.content = chunk
+    def render_to(self, output: BinaryIO, name: str, **kwargs):
+        with instrument.timer(f"template.render:{name}"):
+            html = self.render_string(name, **kwargs)
+        css = self.embedded_css()
+        for module in self._modules.values():
+            finalize = getattr(module, "finalize", None)
+            if finalize is not None:
+                with instrument.timer(f"template.finalize:{type(module).__name__}"):
+                    html, css = finalize(html, css)
+        head_end = html.index(b"</head>") if css else len(html)
+        view = memoryview(html)
+        output.write(view[:head_end])
+        if css:
+            output.write(css)
+        output.write(view[head_end:])
 
-    def finish(*args, **kwargs):
-        pass
+    def render(self, name: str, **kwargs) -> bytes:
+        buffer = io.BytesIO()
+        self.render_to(buffer, name, **kwargs)
+        return buffer.getvalue()
 
 
-class MockTornadoRequest(tornado.httputil.HTTPServerRequest):
-    def __init__(self):
-        self.connection = MockTornadoConnection()
-        self.headers = {}
-        self.method = "GET"
-        self.uri = "localhost"
-        self.remote_ip = "127.0.0.1"
-        self._finish_time = None
-        self._start_time = time.time()
+def render(path: str, profile, asset_url: Callable[[str], str]|None = None, subset_fonts: bool = False) -> str:
+    return Renderer(path, asset_url, subset_fonts).render("index.html", profile=profile).decode("utf-8")
 
 
-def include_b64(path: str):
-    with open(os.path.join("includes", path), "rb") as fh:
-        raw = fh.read()
-        b64 = base64.b64encode(raw)
-        return b64.decode("utf-8")
-
-
-def generate(path: str, profile):
-    tornado.web.RequestHandler._template_loaders.clear()
-    handler = tornado.web.RequestHandler(
-        MockTornadoApplication(path),
-        MockTornadoRequest(),
-    )
-    handler._transforms = []
-    namespace = {
-        "profile": profile,
-    }
-    handler.render("index.html", **namespace)
-    return handler.request.connection.content.decode("utf-8")
+def render_to(output: BinaryIO, path: str, profile, asset_url: Callable[[str], str]|None = None, subset_fonts: bool = False):
+    """
+    Renders a profile's document as UTF-8 straight into a writable binary stream.
+    """
+    Renderer(path, asset_url, subset_fonts).render_to(output, "index.html", profile=profile)
@@ -1,5 +1,7 @@
+import concurrent.futures
+import dataclasses
 from enum import Enum
-import importlib
+import functools
 import json
 import nltk
 import openai
@@ -8,17 +10,21 @@ import os
 import pypdf
 import re
 import spellchecker
-from typing import List
+from typing import Callable, Iterable, List, Set
 
+import cache
+import loader
 import model
 
-nltk.download('words') 
-nltk.download('stopwords')
-from nltk.corpus import words
-from nltk.corpus import stopwords
+# nltk data the checks use, by the path nltk looks it up with
+NLTK_RESOURCES = {
+    "corpora/words": "words",
+    "corpora/stopwords": "stopwords",
+    "tokenizers/punkt": "punkt",
+}
+KNOWN_WORDS_PATH = "known_words.txt"
 
-ALL_WORDS = words.words()
-STOPWORDS = set(stopwords.words('english'))
+_results = cache.DiskCache("tests")
 
 if os.path.exists("openai_api_key.txt"):
     with open("openai_api_key.txt", "rt", encoding="utf-8") as fh:
@@ -26,16 +32,43 @@ if os.path.exists("openai_api_key.txt"):
 else:
     print("No OpenAI API key found")
 
+@functools.lru_cache(maxsize=None)
+def _nltk_data():
+    """
+    Downloads the nltk data the first time it's needed, rather than on import.
+    """
+    for resource, package in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            nltk.download(package, quiet=True)
+
+@functools.lru_cache(maxsize=None)
+def stopwords() -> Set[str]:
+    _nltk_data()
+    return set(nltk.corpus.stopwords.words('english'))
+
+@functools.lru_cache(maxsize=None)
+def all_words() -> List[str]:
+    _nltk_data()
+    return nltk.corpus.words.words()
+
+@functools.lru_cache(maxsize=None)
+def _spell_checker() -> spellchecker.SpellChecker:
+    return spellchecker.SpellChecker()
+
+@functools.lru_cache(maxsize=None)
+def known_words() -> Set[str]:
+    if os.path.exists(KNOWN_WORDS_PATH):
+        with open(KNOWN_WORDS_PATH, "rt", encoding="utf-8") as fh:
+            return {w.lower() for w in fh.read().splitlines() if w}
+    return set()
+
 def spellcheck(words: List[str]):
-    spell_checker = spellchecker.SpellChecker()
+    spell_checker = _spell_checker()
     misspelled = spell_checker.unknown(words)
-    if os.path.exists("known_words.txt"):
-        with open("known_words.txt", "rt", encoding="utf-8") as fh:
-            known_words = set(fh.read().splitlines())
-    else:
-        known_words = set()
-    known_words = {w.lower() for w in known_words if w}
-    misspelled = [w for w in misspelled if w.lower() not in known_words]
+    known = known_words()
+    misspelled = [w for w in misspelled if w.lower() not in known]
     return {w: spell_checker.correction(w) for w in misspelled}
 
 def shrink_whitespace(*args, **kwargs):
@@ -45,8 +78,9 @@ def profile_to_dict(profile: model.Profile):
     def _to_dict(obj):
         if isinstance(obj, list):
             return [_to_dict(x) for x in obj]
-        if hasattr(obj, "__annotations__"):
-            result = {k: _to_dict(v) for k, v in obj.__dict__.items() if v is not None}
+        if dataclasses.is_dataclass(obj):
+            values = ((f.name, getattr(obj, f.name)) for f in dataclasses.fields(obj) if f.init)
+            result = {k: _to_dict(v) for k, v in values if v is not None}
             if hasattr(obj, "TYPE"):
                 result["TYPE"] = obj.TYPE
             return result
@@ -68,30 +102,29 @@ class Problem(Enum):
     BRAVITY = "Bravity"
 
 def test_input(profile_path: str):
-    module_path = profile_path[:-3].replace(os.path.sep, ".")
-    profile_module = importlib.import_module(module_path)
-    profile_obj = profile_module.PROFILE
+    profile_obj = loader.load(profile_path)
     if openai.api_key:
         profile_dict = profile_to_dict(profile_obj)
         profile_json = json.dumps(profile_dict)
         problems, revisions = 0, 0
+        messages = []
         def report_problem(expression: str, problem: Problem, recommendation: str, revised: str):
             nonlocal problems, revisions
-            print(f"Problem with {problem.value} in {expression}: {recommendation}")
+            messages.append(f"Problem with {problem.value} in {expression}: {recommendation}")
             problems += 1
             try:
                 value = eval(expression, {"cv": profile_dict})
-                print(f"Value: {value}")
+                messages.append(f"Value: {value}")
                 try:
                     expression += " = \"" + revised.replace("\"", "\\\"") + "\""
-                    print(expression)
+                    messages.append(expression)
                     eval(expression, {"cv": profile_dict})
                     revisions += 1
                 except Exception as e:
-                    print(f"Error applying the revision: {e}")
+                    messages.append(f"Error applying the revision: {e}")
             except:
                 pass
-            print(f"Revised value: {revised}")
+            messages.append(f"Revised value: {revised}")
         chat = Conversation(model="gpt-4")
         chat.add_function(report_problem)
         result = chat.ask(f"""Review the following CV from a highly critical recruiter's perspective.
@@ -101,12 +134,13 @@ Be concise and clear. Call the `report_problem` function for each issue, instead
 When revising the text, keep the tone of the original text, the information it conveys and don't change the length too drastically.
 Here's the CV represented as a JSON:
 {profile_json}""")
+        yield from messages
         if problems > 0:
-            print(f"Found {problems} problems")
+            yield f"Found {problems} problems"
             if revisions > 0:
-                print(f"Revised {revisions} values")
+                yield f"Revised {revisions} values"
         elif result:
-            print(result)
+            yield result
 
 def test_html(html_path: str):
     if False:
@@ -124,9 +158,11 @@ def test_pdf(pdf_path: str):
         yield f"More than one page ({pages_count})"
 
     whole_text = " ".join([p.extract_text() for p in reader.pages])
+    _nltk_data()
     words = nltk.word_tokenize(whole_text)
     words = [w for w in words if w.isalpha()]
-    words = [w for w in words if w not in STOPWORDS]
+    stop = stopwords()
+    words = [w for w in words if w not in stop]
     words = [w for w in words if len(w) > 2]
     words = set(words)
     misspelled = spellcheck(words)
@@ -138,17 +174,72 @@ def test_pdf(pdf_path: str):
             else:
                 yield f"\t{w}"
 
-def run_all(profile: str):
-    print(f"[{profile}] Testing... (this may take a while)")
+def _cache_key(test: Callable, path: str) -> str:
+    parts = [test.__name__, cache.file_digest(path)]
+    if test is test_pdf:
+        parts.append(",".join(sorted(known_words())))
+    if test is test_input:
+        parts.append(str(bool(openai.api_key)))
+    return cache.digest(*parts)
+
+def run_test(test: Callable[[str], Iterable[str]], path: str) -> List[str]:
+    """
+    The problems `test` finds in the file at `path`.
+    Results are cached by the file's content hash, so unchanged files aren't checked again.
+    """
+    if not os.path.exists(path):
+        return [f"{path} doesn't exist"]
+    key = _cache_key(test, path)
+    cached = _results.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    problems = [str(problem) for problem in test(path)]
+    _results.set(key, json.dumps(problems).encode("utf-8"))
+    return problems
+
+def check(profile: str) -> List[str]:
+    """
+    The problems found in the profile's input and outputs.
+    """
     tests = [
-        (test_input, os.path.join("input", profile + ".py")),
+        (test_input, loader.path(profile, "input")),
         (test_html, os.path.join("output", profile + ".html")),
         (test_pdf, os.path.join("output", profile + ".pdf")),
     ]
-    any_problems = False
+    problems = []
     for test, path in tests:
-        for problem in test(path):
-            any_problems = True
-            print(problem)
-    if not any_problems:
+        problems += run_test(test, path)
+    return problems
+
+def _print_result(problems: List[str]):
+    for problem in problems:
+        print(problem)
+    if not problems:
         print("OK")
+
+def run_all(profile: str):
+    print(f"[{profile}] Testing... (this may take a while)")
+    _print_result(check(profile))
+
+def _init_worker(cache_dir: str|None):
+    cache.configure(cache_dir)
+
+def run_many(profiles: List[str], jobs: int = 1):
+    """
+    Tests the profiles on up to `jobs` processes, printing each profile's results as it's done.
+    """
+    if jobs <= 1 or len(profiles) <= 1:
+        for profile in profiles:
+            run_all(profile)
+        return
+    print(f"Testing {len(profiles)} profiles ({jobs} jobs)... (this may take a while)")
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(cache.CACHE_DIR,)) as executor:
+        futures = {executor.submit(check, profile): profile for profile in profiles}
+        for future in concurrent.futures.as_completed(futures):
+            profile = futures[future]
+            print(f"[{profile}] Tested")
+            try:
+                problems = future.result()
+            except Exception as e:
+                problems = [f"Failed to test: {e}"]
+            _print_result(problems)
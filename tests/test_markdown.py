@@ -0,0 +1,71 @@
+"""
+Golden tests for MarkdownModule: its output must match the corpus, and the renderer it replaced.
+
+    python -m pytest tests
+"""
+import json
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import template
+
+with open(os.path.join(os.path.dirname(__file__), "markdown_corpus.json"), "r", encoding="utf-8") as fh:
+    CORPUS = json.load(fh)
+
+
+@pytest.fixture(scope="module")
+def markdown() -> template.MarkdownModule:
+    return template.MarkdownModule(template.Renderer(os.path.join(ROOT, "templates", "default")))
+
+
+def reference_render(text: str) -> str:
+    """
+    The renderer before the single-pass rewrite, searching the remaining text with every pattern after each
+    replacement. The only change is the fix for string replacements, which used to append
+    `pattern.sub(repl, text, 1)`, the whole substituted remainder, instead of just the replacement.
+    """
+    result = []
+    while text:
+        for pattern, repl in template.MarkdownModule.TRANSFORMERS:
+            match = pattern.search(text)
+            if match:
+                result.append(text[:match.start()])
+                if isinstance(repl, str):
+                    result.append(match.expand(repl))
+                else:
+                    result.append(repl(match))
+                text = text[match.end():]
+                break
+        else:
+            result.append(text)
+            text = ""
+    return "".join(result)
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[repr(case["input"])[:40] for case in CORPUS])
+def test_corpus(markdown, case):
+    assert markdown.render(case["input"]) == case["expected"]
+
+
+def test_corpus_matches_reference():
+    for case in CORPUS:
+        assert reference_render(case["input"]) == case["expected"]
+
+
+FRAGMENTS = [
+    "word", "**", "*", "__", "_", "[", "]", "(", ")", "[text](https://example.com)", "https://example.com/",
+    "www.example.com", "jane@example.com", "+1 234 567 8901", "0123456789", " ", "  ", "\n", "\t", "ü",
+]
+
+
+def test_random_matches_reference(markdown):
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 30)))
+        assert markdown.render(text) == reference_render(text), text
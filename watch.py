@@ -0,0 +1,127 @@
+"""
+Regenerates profiles as their files change, for --continuous and --preview.
+"""
+import os
+import threading
+import time
+import traceback
+from typing import Callable, Set
+import watchdog.events
+import watchdog.observers
+
+import deps
+
+
+class GenerateHandler(watchdog.events.FileSystemEventHandler):
+    """
+    Regenerates the profiles affected by file changes on a background thread.
+
+    Changes are coalesced until no new ones arrived for `debounce` seconds.
+    A rebuild is abandoned between profiles when newer changes arrive, and its remaining profiles
+    are rebuilt together with the newly affected ones.
+    """
+    WATCHED_DIRS = ("input", "templates", "includes")
+    IGNORED_SUFFIXES = ("~", ".tmp", ".swp", ".swx", ".pyc")
+
+    debounce: float
+    on_generated: Callable[[str], None]|None
+    _pending: Set[str]
+    _leftover: Set[str]
+
+    def __init__(self, gen, debounce: float = 0.3):
+        self.gen = gen
+        self.debounce = debounce
+        self.on_generated = None
+        self._pending = set()
+        self._leftover = set()
+        self._last_change = 0.0
+        self._stopped = False
+        self._changed = threading.Condition()
+        self._worker = threading.Thread(target=self._run, name="GenerateHandler", daemon=True)
+        self._worker.start()
+
+    def _ignored(self, path: str) -> bool:
+        parts = deps.normalize(path).split(os.path.sep)
+        if "__pycache__" in parts or any(p.startswith(".") and p != ".." for p in parts):
+            return True
+        return path.endswith(self.IGNORED_SUFFIXES)
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type in ("opened", "closed_no_write"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        paths = [p for p in paths if p and not self._ignored(p)]
+        if not paths:
+            return
+        with self._changed:
+            self._pending.update(paths)
+            self._last_change = time.monotonic()
+            self._changed.notify()
+
+    def _wait_for_changes(self) -> Set[str]|None:
+        with self._changed:
+            while not self._pending and not self._stopped:
+                self._changed.wait()
+            while not self._stopped:
+                remaining = self._last_change + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            if self._stopped:
+                return None
+            paths, self._pending = self._pending, set()
+            return paths
+
+    def _run(self):
+        while True:
+            paths = self._wait_for_changes()
+            if paths is None:
+                return
+            try:
+                self._rebuild(paths)
+            except Exception:
+                # Keep watching, so fixing whatever went wrong triggers the next rebuild
+                print("Failed to regenerate changed profiles:")
+                traceback.print_exc()
+
+    def _rebuild(self, paths: Set[str]):
+        profiles = sorted(set(self.gen.affected_profiles(sorted(paths))) | self._leftover)
+        self._leftover = set()
+        for i, profile in enumerate(profiles):
+            with self._changed:
+                superseded = self._stopped or bool(self._pending)
+            if superseded:
+                self._leftover.update(profiles[i:])
+                break
+            if self.gen.generate_html(profile) and self.on_generated is not None:
+                self.on_generated(profile)
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify()
+        self._worker.join()
+
+
+def run(gen, debounce: float = 0.3, preview_port: int|None = None):
+    """
+    Watches the profiles' files until interrupted, optionally serving live previews.
+    """
+    gen.generate_html(profiles=gen.stale_profiles())
+    observer = watchdog.observers.Observer()
+    handler = GenerateHandler(gen, debounce)
+    for path in GenerateHandler.WATCHED_DIRS:
+        if os.path.isdir(path):
+            observer.schedule(handler, path, recursive=True)
+    observer.start()
+    try:
+        if preview_port is not None:
+            import preview
+            preview.serve(gen, handler, preview_port)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+    handler.stop()